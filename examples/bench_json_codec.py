@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+
+# The helpers live in main/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main"))
+
+from json_codec import BACKENDS, decode_rows, get_backend
+
+ROWS = 100000
+FIELDS = ["scode", "mvalidtime", "mvalue"]
+
+class FakeResponse:
+    """Just enough of a requests response for decode_rows."""
+    encoding = "utf-8"
+
+    def __init__(self, content):
+        self.content = content
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+def make_body(rows):
+    """A flat,node history response like Ninja sends without select."""
+    data = []
+    for i in range(rows):
+        data.append({
+            "scode": f"ASM_{i % 1500:08d}",
+            "sname": f"Station {i % 1500}",
+            "stype": "EChargingStation",
+            "sactive": True,
+            "savailable": True,
+            "scoordinate": {"x": 11.356, "y": 46.333, "srid": 4326},
+            "smetadata": {"city": "Bolzano", "provider": "DRIVE", "capacity": 2},
+            "tname": "number-available",
+            "tunit": "",
+            "ttype": "Instantaneous",
+            "mperiod": 300,
+            "mvalidtime": f"2024-05-01 {i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}.000+0000",
+            "mvalue": i % 3
+        })
+    return {"offset": 0, "data": data, "limit": -1}
+
+def make_data_tree(stations):
+    """A pushRecords body with one record per station, like add_station_data builds."""
+    return {
+        "name": "(default)",
+        "branch": {
+            f"ASM_{i:08d}": {
+                "name": "(default)",
+                "branch": {
+                    "availability": {
+                        "name": "(default)",
+                        "branch": {},
+                        "data": [{"timestamp": 1714564800000, "value": 66.6, "period": 100, "_t": "it.bz.idm.bdp.dto.SimpleRecordDto"}]
+                    }
+                },
+                "data": []
+            } for i in range(stations)
+        },
+        "data": [],
+        "provenance": "1"
+    }
+
+def bench(label, func, rows):
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<32} {elapsed * 1e9 / rows:10.0f} ns/row")
+
+def main():
+    stdlib_dumps = BACKENDS["stdlib"][1]
+    body = stdlib_dumps(make_body(ROWS)).encode()
+    data_tree = make_data_tree(1500)
+    print(f"{ROWS} rows, {len(body) / ROWS:.0f} bytes/row, backends: {', '.join(BACKENDS)}")
+
+    for name in BACKENDS:
+        name, loads, dumps = get_backend(name)
+        for row_type in ("dict", "record", "columns"):
+            bench(f"{name} decode -> {row_type}", lambda: decode_rows(FakeResponse(body), FIELDS, row_type, name), ROWS)
+        bench(f"{name} encode data_tree", lambda: dumps(data_tree), 1500)
+
+if __name__ == "__main__":
+    main()
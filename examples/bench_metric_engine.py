@@ -0,0 +1,95 @@
+import os
+import random
+import sys
+import time
+from array import array
+
+# The helpers live in main/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main"))
+
+from average_availability import AVAILABILITY_DATATYPE, compute_availability_percentage, compute_used_charging
+from metric_engine import KERNELS, compute_batch_metrics, flat_columns, np, window_columns
+from ninja_reader import format_mvalidtime
+from query_planner import compute_station_metrics, declare_metric
+from resampling import compute_time_weighted_availability
+from series import SeriesBatch, StationSeries
+
+STATIONS = 1500
+STEP_MS = 5 * 60 * 1000
+SAMPLES = 24 * 3600 * 1000 // STEP_MS
+
+def make_network_day(now_ms):
+    """A day of number-available every 5 minutes for every station, with some stations missing samples or silent."""
+    random.seed(1)
+    batch = SeriesBatch()
+    rows = {}
+    for i in range(STATIONS):
+        name = f"ASM_{i:08d}"
+        if i % 50 == 0:
+            # No measurements at all
+            continue
+        times = array('q')
+        values = array('d')
+        for sample in range(SAMPLES):
+            if random.random() < 0.1:
+                continue
+            times.append(now_ms - (SAMPLES - sample) * STEP_MS)
+            values.append(float(random.choice([0, 0, 1, 2])))
+        batch.put(name, AVAILABILITY_DATATYPE, StationSeries(times=times, values=values))
+        rows[name] = [{"scode": name, "mvalidtime": format_mvalidtime(t), "mvalue": v} for t, v in zip(times, values)]
+    return batch, rows
+
+def bench(label, func):
+    started = time.perf_counter()
+    result = func()
+    print(f"{label:<40} {time.perf_counter() - started:8.3f} s")
+    return result
+
+def main():
+    now_ms = round(time.time() * 1000)
+    batch, rows = make_network_day(now_ms)
+    names = [f"ASM_{i:08d}" for i in range(STATIONS)]
+    metrics = [
+        declare_metric("availability", compute_time_weighted_availability, AVAILABILITY_DATATYPE, 1, names, kernel="time_weighted_availability", carry_in=True),
+        declare_metric("sampled-availability", compute_availability_percentage, AVAILABILITY_DATATYPE, 1, names, kernel="availability_percentage"),
+        declare_metric("usage", compute_used_charging, AVAILABILITY_DATATYPE, 24, names, kernel="used_charging")
+    ]
+    # The time weighted metric needs a StationSeries, the others also run on dict rows
+    row_metrics = [metric for metric in metrics if not metric["carry_in"]]
+    print(f"{STATIONS} stations, {sum(len(station_rows) for station_rows in rows.values())} rows, NumPy: {np is not None}")
+
+    def per_row():
+        # The metric functions over lists of dict rows, one station at a time
+        results = {}
+        for name in names:
+            station_rows = rows.get(name, [])
+            results[name] = {}
+            for metric in row_metrics:
+                from_ms = now_ms - metric["window_hours"] * 3600 * 1000
+                window = [row for row, t in zip(station_rows, batch.get(name, AVAILABILITY_DATATYPE).times) if t >= from_ms]
+                results[name][metric["name"]] = metric["compute"](window)
+        return results
+
+    expected = bench("metric functions on dict rows", per_row)
+    per_series = bench("metric functions on StationSeries", lambda: {name: compute_station_metrics(metrics, batch, name, now_ms) for name in names})
+    vectorized = bench("metric engine", lambda: compute_batch_metrics(metrics, batch, now_ms))
+    if np is not None:
+        # The engine without building the flat columns and the result dicts
+        flat = flat_columns(batch, AVAILABILITY_DATATYPE)
+
+        def kernels():
+            for metric in metrics:
+                from_ms = now_ms - metric["window_hours"] * 3600 * 1000
+                stations, starts, times, values = window_columns(batch, AVAILABILITY_DATATYPE, from_ms, flat=flat, carry_in=metric["carry_in"])
+                KERNELS[metric["kernel"]](starts, times, values, from_ms, now_ms)
+
+        bench("metric engine kernels on flat columns", kernels)
+
+    row_names = [metric["name"] for metric in row_metrics]
+    if expected != {name: {metric_name: values[metric_name] for metric_name in row_names} for name, values in per_series.items()} or per_series != vectorized:
+        print("Metric engine results differ from the metric functions!")
+        sys.exit(1)
+    print("Same results")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import os
+import sys
+import time
+
+# The helpers live in main/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main"))
+
+from timestamps import hour_cache, parse_mvalidtime, parse_mvalidtime_strptime, parse_mvalidtimes
+
+ROWS = 200000
+
+def make_mvalidtimes(rows):
+    """A day of measurements every 5 minutes, for many stations, oldest first."""
+    mvalidtimes = []
+    for i in range(rows):
+        second = i * 86400 // rows
+        mvalidtimes.append(f"2024-05-01 {second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}.{i % 1000:03d}+0000")
+    return mvalidtimes
+
+def bench(label, func, rows):
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<32} {rows / elapsed:12.0f} rows/s")
+    return result
+
+def main():
+    mvalidtimes = make_mvalidtimes(ROWS)
+    print(f"{ROWS} mvalidtimes")
+
+    expected = bench("strptime", lambda: [parse_mvalidtime_strptime(value) for value in mvalidtimes], ROWS)
+    hour_cache.clear()
+    parsed = bench("parse_mvalidtime (cold cache)", lambda: [parse_mvalidtime(value) for value in mvalidtimes], ROWS)
+    parsed_array = bench("parse_mvalidtimes", lambda: parse_mvalidtimes(mvalidtimes), ROWS)
+
+    if parsed != expected or list(parsed_array) != expected:
+        print("Parsed timestamps differ from strptime!")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
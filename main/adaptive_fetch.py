@@ -0,0 +1,157 @@
+import asyncio
+import requests
+import time
+
+from async_client import DEFAULT_CONCURRENCY, run_sync
+from odh_client import read_client
+from json_codec import decode_rows
+from ninja_reader import DEFAULT_SELECT, batch_station_ids, build_history_url, build_select, format_query_date, parse_query_date, record_response, split_by_station
+
+# Ninja's limits, see NINJA_RESPONSE_MAX_SIZE_MB and NINJA_QUERY_TIMEOUT_SEC in docker-compose.yml
+NINJA_RESPONSE_MAX_BYTES = 100 * 1024 * 1024
+NINJA_QUERY_TIMEOUT_SEC = 30
+
+# What a chunk aims for: well below both limits, so a busier than
+# expected chunk still fits
+TARGET_RESPONSE_BYTES = NINJA_RESPONSE_MAX_BYTES // 5
+TARGET_LATENCY_SEC = NINJA_QUERY_TIMEOUT_SEC / 3
+
+INITIAL_CHUNK_MS = 6 * 3600 * 1000
+MIN_CHUNK_MS = 5 * 60 * 1000
+MAX_CHUNK_MS = 31 * 24 * 3600 * 1000
+
+def new_chunk_state(chunk_ms=INITIAL_CHUNK_MS):
+    """Observed request cost of a fetch, shared by all its chunks."""
+    return {
+        "chunk_ms": chunk_ms,
+        "rows_per_station_hour": None,
+        "bytes_per_row": None
+    }
+
+def observe_chunk(state, station_count, duration_ms, rows, size_bytes, seconds):
+    """Update the estimates with a finished chunk and pick the next chunk size.
+
+    The chunk size at most doubles per step, and shrinks when the response
+    was close to the size or time limit.
+    """
+    if rows > 0:
+        rows_per_station_hour = rows / station_count / (duration_ms / 3600000)
+        bytes_per_row = size_bytes / rows
+        if state["rows_per_station_hour"] is None:
+            state["rows_per_station_hour"] = rows_per_station_hour
+            state["bytes_per_row"] = bytes_per_row
+        else:
+            state["rows_per_station_hour"] = 0.5 * state["rows_per_station_hour"] + 0.5 * rows_per_station_hour
+            state["bytes_per_row"] = 0.5 * state["bytes_per_row"] + 0.5 * bytes_per_row
+
+    if state["rows_per_station_hour"]:
+        target_rows = TARGET_RESPONSE_BYTES / state["bytes_per_row"]
+        chunk_ms = target_rows / (state["rows_per_station_hour"] * station_count) * 3600000
+    else:
+        chunk_ms = MAX_CHUNK_MS
+
+    if seconds > TARGET_LATENCY_SEC:
+        chunk_ms = min(chunk_ms, duration_ms * TARGET_LATENCY_SEC / seconds)
+    if size_bytes > NINJA_RESPONSE_MAX_BYTES / 2:
+        chunk_ms = min(chunk_ms, duration_ms / 2)
+
+    state["chunk_ms"] = round(max(MIN_CHUNK_MS, min(MAX_CHUNK_MS, chunk_ms, state["chunk_ms"] * 2)))
+
+def shrink_chunk(state, duration_ms):
+    """A chunk failed: the next ones are at most half its size."""
+    state["chunk_ms"] = max(MIN_CHUNK_MS, min(state["chunk_ms"], duration_ms // 2))
+
+def get_history_chunk(host, station_type, from_ms, to_ms, station_ids, datatypes, select):
+    """Fetch [from_ms, to_ms) of the stations with a single request.
+
+    Returns the rows, the size of the response in bytes and how many seconds it took.
+    """
+    headers = {
+        "Content-Type": "application/json"
+    }
+    url = build_history_url(host, station_type, format_query_date(from_ms), format_query_date(to_ms), station_ids, datatypes, select)
+    started = time.monotonic()
+    response = read_client.get(url, headers=headers, stream=True)
+    response.raise_for_status()
+    fields = build_select(datatypes, select).split(",") if select else None
+    data, size = decode_rows(response, fields)
+    record_response(response, len(data), size)
+    return data, size, time.monotonic() - started
+
+async def fetch_batch_adaptive(client, host, station_type, from_ms, to_ms, station_ids, datatypes, select, series, state):
+    """Fetch the window of one station batch in adaptively sized chunks, concurrently.
+
+    Each free slot takes the next chunk at the current chunk size. A failed
+    chunk is split in two and retried, down to MIN_CHUNK_MS.
+    """
+    cursor = [from_ms]
+    retry = []
+    in_flight = [0]
+
+    def next_chunk():
+        if retry:
+            return retry.pop()
+        if cursor[0] < to_ms:
+            chunk = (cursor[0], min(cursor[0] + state["chunk_ms"], to_ms))
+            cursor[0] = chunk[1]
+            return chunk
+        return None
+
+    async def worker():
+        while True:
+            chunk = next_chunk()
+            if chunk is None:
+                if in_flight[0] == 0:
+                    return
+                # Another worker may still split a failed chunk
+                await asyncio.sleep(0.05)
+                continue
+
+            chunk_from, chunk_to = chunk
+            in_flight[0] += 1
+            try:
+                data, size, seconds = await client.call(host, get_history_chunk, host, station_type, chunk_from, chunk_to, station_ids, datatypes, select)
+            except requests.RequestException as e:
+                if chunk_to - chunk_from <= MIN_CHUNK_MS:
+                    raise
+                print(f"Chunk {format_query_date(chunk_from)} - {format_query_date(chunk_to)} failed, splitting it: {e}")
+                shrink_chunk(state, chunk_to - chunk_from)
+                middle = (chunk_from + chunk_to) // 2
+                retry.extend([(middle, chunk_to), (chunk_from, middle)])
+                continue
+            finally:
+                in_flight[0] -= 1
+
+            observe_chunk(state, len(station_ids), chunk_to - chunk_from, len(data), size, seconds)
+            split_by_station(data, series)
+
+    await asyncio.gather(*(worker() for _ in range(client.concurrency)))
+
+async def get_charging_stations_status_adaptive_async(client, host, station_type, from_date, to_date, station_ids, datatypes=None, select=DEFAULT_SELECT, failed=None):
+    """Like get_charging_stations_status_batch, but splits each batch's window into chunks that stay below Ninja's limits."""
+    from_ms = parse_query_date(from_date)
+    to_ms = parse_query_date(to_date)
+    series = {station_id: [] for station_id in station_ids}
+    # Stations of a type have similar sampling rates, so the estimates are shared between batches
+    state = new_chunk_state()
+
+    async def fetch_batch(batch):
+        batch_series = {station_id: [] for station_id in batch}
+        try:
+            await fetch_batch_adaptive(client, host, station_type, from_ms, to_ms, batch, datatypes, select, batch_series, state)
+        except requests.RequestException as e:
+            print(f"Error fetching data for {len(batch)} stations ({batch[0]} - {batch[-1]}): {e}")
+            if failed is not None:
+                failed.extend(batch)
+            return
+        # Chunks finish out of order
+        for station_id, rows in batch_series.items():
+            rows.sort(key=lambda row: row['mvalidtime'])
+        series.update(batch_series)
+
+    await asyncio.gather(*(fetch_batch(batch) for batch in batch_station_ids(host, station_type, from_date, to_date, station_ids, datatypes=datatypes, select=select)))
+    return series
+
+def get_charging_stations_status_adaptive(host, station_type, from_date, to_date, station_ids, datatypes=None, select=DEFAULT_SELECT, failed=None, concurrency=DEFAULT_CONCURRENCY):
+    """Sync facade of get_charging_stations_status_adaptive_async."""
+    return run_sync(get_charging_stations_status_adaptive_async, host, station_type, from_date, to_date, station_ids, datatypes, select, failed, concurrency=concurrency, hosts=1)
@@ -0,0 +1,111 @@
+from odh_client import read_client
+from json_codec import decode_rows
+from ninja_reader import DEFAULT_PAGE_SIZE, iter_pages, record_response
+
+# Aggregate functions of Ninja's select (`count(scode)`, `avg(mvalue)`, ...).
+# Ninja groups by the plain fields of the select, like SQL's GROUP BY.
+AGGREGATE_FUNCTIONS = ["count", "min", "max", "avg", "sum"]
+
+def parse_aggregate(expression):
+    """Split `avg(mvalue)` into ("avg", "mvalue"). None if expression is not an aggregate of AGGREGATE_FUNCTIONS."""
+    if not expression.endswith(")") or "(" not in expression:
+        return None
+    function, field = expression[:-1].split("(", 1)
+    if function not in AGGREGATE_FUNCTIONS or not field:
+        return None
+    return function, field
+
+def check_aggregates(aggregates):
+    """Raise ValueError if any of the expressions is not an aggregate we (and Ninja) can compute."""
+    invalid = [expression for expression in aggregates if parse_aggregate(expression) is None]
+    if invalid:
+        raise ValueError(f"Not an aggregate of {', '.join(AGGREGATE_FUNCTIONS)}: {', '.join(invalid)}")
+
+def build_aggregate_select(group_by, aggregates):
+    """The select of an aggregate query, e.g. `scode,count(mvalue)`."""
+    return ",".join(group_by + aggregates)
+
+def can_push_down(url, aggregates):
+    """Whether Ninja can compute the aggregates of a query. Only the flat representations support them."""
+    return "/tree" not in url and all(parse_aggregate(expression) for expression in aggregates)
+
+def aggregate_rows(rows, group_by, aggregates, groups=None):
+    """Client side version of Ninja's aggregation, over an iterable of rows.
+
+    Like SQL, null values are skipped. Pass the groups of a previous call to
+    continue it with more rows. Returns the groups, see aggregate_results.
+    """
+    check_aggregates(aggregates)
+    parsed = [parse_aggregate(expression) for expression in aggregates]
+    fields = list(dict.fromkeys(field for function, field in parsed))
+    groups = {} if groups is None else groups
+    for row in rows:
+        key = tuple(row.get(field) for field in group_by)
+        group = groups.get(key)
+        if group is None:
+            # count, sum, min, max per field
+            group = groups[key] = {field: [0, 0, None, None] for field in fields}
+        for field in fields:
+            value = row.get(field)
+            if value is None:
+                continue
+            state = group[field]
+            state[0] += 1
+            if isinstance(value, (int, float)):
+                state[1] += value
+            if state[2] is None or value < state[2]:
+                state[2] = value
+            if state[3] is None or value > state[3]:
+                state[3] = value
+    return groups
+
+def aggregate_results(groups, group_by, aggregates):
+    """The groups of aggregate_rows as rows like Ninja returns them: the group fields and one field per aggregate."""
+    results = []
+    for key, group in groups.items():
+        result = {field: value for field, value in zip(group_by, key) if value is not None}
+        for expression in aggregates:
+            function, field = parse_aggregate(expression)
+            count, total, minimum, maximum = group[field]
+            if function == "count":
+                result[expression] = count
+            elif function == "sum":
+                result[expression] = total if count else None
+            elif function == "avg":
+                result[expression] = total / count if count else None
+            elif function == "min":
+                result[expression] = minimum
+            else:
+                result[expression] = maximum
+        results.append(result)
+    return results
+
+def get_aggregates(url_for_select, group_by, aggregates, pushdown=True, page_size=DEFAULT_PAGE_SIZE):
+    """Aggregate a Ninja query, e.g. count the stations by pactive.
+
+    url_for_select(select, limit, offset) builds the URL of the query. When
+    possible, Ninja does the aggregation and the result is one small
+    response. Otherwise (or if Ninja rejects the query) the plain fields are
+    fetched page by page and aggregated here. Returns a list of rows with the
+    group_by fields and one field per aggregate expression. Raises ValueError
+    if an expression is not an aggregate, before sending any request.
+    """
+    check_aggregates(aggregates)
+    if pushdown and can_push_down(url_for_select("", -1, 0), aggregates):
+        headers = {
+            "Content-Type": "application/json"
+        }
+        response = read_client.get(url_for_select(build_aggregate_select(group_by, aggregates), -1, 0), headers=headers, stream=True)
+        if response.status_code != 400:
+            response.raise_for_status()
+            data, size = decode_rows(response)
+            record_response(response, len(data), size)
+            return data
+        print(f"Aggregation rejected by Ninja, computing it client side: {response.text}")
+
+    fields = list(dict.fromkeys(group_by + [parse_aggregate(expression)[1] for expression in aggregates]))
+    select = ",".join(fields)
+    groups = {}
+    for data in iter_pages(lambda limit, offset: url_for_select(select, limit, offset), page_size, fields):
+        aggregate_rows(data, group_by, aggregates, groups)
+    return aggregate_results(groups, group_by, aggregates)
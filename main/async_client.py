@@ -0,0 +1,45 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+# Requests in flight per host
+DEFAULT_CONCURRENCY = 8
+
+class AsyncOdhClient:
+    """asyncio client for the Open Data Hub APIs, with at most `concurrency` requests in flight per host.
+
+    The calls themselves go through the pooled OdhClient sessions (there is no
+    asyncio HTTP library in our dependencies), running in the executor of the
+    loop so they don't block it. Any of the blocking helpers (get_..., upsert_...,
+    add_station_data) can be awaited with call().
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        self.concurrency = concurrency
+        self.semaphores = {}
+
+    def semaphore(self, host):
+        netloc = urlsplit(host).netloc or host
+        if netloc not in self.semaphores:
+            self.semaphores[netloc] = asyncio.Semaphore(self.concurrency)
+        return self.semaphores[netloc]
+
+    async def call(self, host, func, *args, **kwargs):
+        """Run a blocking helper that talks to host, waiting for a free slot of that host first."""
+        async with self.semaphore(host):
+            return await asyncio.get_running_loop().run_in_executor(None, lambda: func(*args, **kwargs))
+
+def run_sync(coroutine_function, *args, concurrency=DEFAULT_CONCURRENCY, hosts=2):
+    """Sync facade: run coroutine_function(client, *args) to completion and return its result.
+
+    Sizes the thread pool for `concurrency` requests in flight on each of
+    `hosts` hosts. The HTTP connection pools are sized once at startup (see
+    odh_client.set_pool_size), the defaults fit DEFAULT_CONCURRENCY.
+    """
+
+    async def run():
+        with ThreadPoolExecutor(max_workers=concurrency * hosts) as executor:
+            asyncio.get_running_loop().set_default_executor(executor)
+            return await coroutine_function(AsyncOdhClient(concurrency), *args)
+
+    return asyncio.run(run())
@@ -1,7 +1,26 @@
+import asyncio
 import requests
+import threading
 from datetime import datetime, timezone
 import time
 
+from odh_client import auth_client, print_request_stats, read_client, set_pool_size, write_client
+from async_client import DEFAULT_CONCURRENCY, run_sync
+from staged_pipeline import StagedPipeline
+from json_codec import decode_rows, dumps
+from ninja_reader import DEFAULT_SELECT, batch_station_ids, build_history_url, format_query_date, get_charging_stations_status_batch, get_projection_ratio, iter_pages, print_read_stats
+from range_cache import get_charging_stations_status_cached, open_range_cache
+from history_store import load_history_store, merge_incremental_fetch, plan_incremental_fetch, save_history_store
+from query_planner import compute_metrics, declare_metric, plan_queries
+from series import SeriesBatch, measurement_values
+from resampling import compute_time_weighted_availability
+from change_detection import detect_changes, get_latest_measurements, get_previous_results, remember_results
+from station_catalog import get_catalog, get_station, load_catalog
+from rate_limiter import print_limiter_stats
+from hourly_buckets import aggregate_hourly, load_hourly_state, new_store_measurements, save_hourly_state
+from charging_events import daily_event_counts, day_end_ms, day_key, load_event_state, save_event_state
+from charging_sessions import daily_average_durations, load_session_totals, save_session_totals, update_charging_sessions
+
 def print_response_details(current_step, response):
     """Helper function to print the details of the response."""
     print(f"Step: {current_step}")
@@ -36,7 +55,7 @@ def get_auth_token():
     }
 
     # Make the POST request to get the auth token
-    response = requests.post(auth_url, data=payload, headers=headers)
+    response = auth_client.post(auth_url, data=payload, headers=headers)
 
     # If the request was successful, return the access token
     if response.status_code == 200:
@@ -62,7 +81,7 @@ def create_provenance(host, auth_token, prn, prv, uuid, data_collector, data_col
         "lineage": lineage
     }
 
-    response = requests.post(url, json=payload, headers=headers)
+    response = write_client.post(url, data=dumps(payload), headers=headers)
     return response
 
 def sync_stations(host, auth_token, station_type, stations_data, prn=None, prv=None, syncState=True, onlyActivation=False):
@@ -72,7 +91,7 @@ def sync_stations(host, auth_token, station_type, stations_data, prn=None, prv=N
         "Content-Type": "application/json",
         "Authorization": f"Bearer {auth_token}"
     }
-    response = requests.post(url, json=stations_data, headers=headers)
+    response = write_client.post(url, data=dumps(stations_data), headers=headers)
     return response
 
 def sync_data_types(host, auth_token, data_types, prn=None, prv=None):
@@ -82,7 +101,7 @@ def sync_data_types(host, auth_token, data_types, prn=None, prv=None):
         "Content-Type": "application/json",
         "Authorization": f"Bearer {auth_token}"
     }
-    response = requests.post(url, json=data_types, headers=headers)
+    response = write_client.post(url, data=dumps(data_types), headers=headers)
     return response
 
 def push_records(host, auth_token, station_type, data_tree, prn=None, prv=None):
@@ -93,7 +112,7 @@ def push_records(host, auth_token, station_type, data_tree, prn=None, prv=None):
         "Authorization": f"Bearer {auth_token}"
     }
 
-    response = requests.post(url, json=data_tree, headers=headers)
+    response = write_client.post(url, data=dumps(data_tree), headers=headers)
     return response
 
 def get_charging_stations(host, station_type):
@@ -101,20 +120,29 @@ def get_charging_stations(host, station_type):
     headers = {
         "Content-Type": "application/json"
     }
-    response = requests.get(url, headers=headers)
+    response = read_client.get(url, headers=headers)
     return response
 
-def get_charging_stations_status(host, station_type, from_date, to_date, station_id):
-    url = f"{host}/{station_type}/%2A/{from_date}/{to_date}?limit=-1&offset=0&shownull=false&distinct=true&where=sactive.eq.true,scode.in.%28%22{station_id}%22%29&timezone=UTC" #
+# How main() runs the stations: "async" (process_stations) or "staged" (process_stations_staged)
+PIPELINE_MODE = "async"
+
+# Threads per stage of process_stations_staged
+FETCH_WORKERS = 4
+COMPUTE_WORKERS = 2
+WRITE_WORKERS = 8
+
+# Data types the availability metric is computed from
+AVAILABILITY_DATATYPE = "number-available"
+AVAILABILITY_DATATYPES = [AVAILABILITY_DATATYPE]
+
+def get_charging_stations_status(host, station_type, from_date, to_date, station_id, datatypes=None, select=DEFAULT_SELECT):
+    url = build_history_url(host, station_type, from_date, to_date, [station_id], datatypes, select)
     headers = {
         "Content-Type": "application/json"
     }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response
-    else:
-        return []
-    
+    # Failed requests are retried by read_client, the caller checks the status of the last attempt
+    return read_client.get(url, headers=headers, stream=True)
+
 def upsert_datatype(host, auth_token, prn, prv, data_type_name, data_type_unit):
     #3 Sync Data Types
     data_types = [
@@ -182,55 +210,297 @@ def add_station_data(host, auth_token, provenance_id, station_type, station_id,
 
     return push_records(host, auth_token, station_type, data_tree)
 
-from datetime import datetime, timedelta
+def add_station_records(host, auth_token, provenance_id, station_type, station_id, measure_type, records, period=100):
+    """Push several (timestamp, value) records of one station and data type in one request."""
+    data_tree = {
+        "name": "(default)",
+        "branch": {
+            station_id: {
+                "name": "(default)",
+                "branch": {
+                    measure_type: {
+                        "name": "(default)",
+                        "branch": {},
+                        "data": [
+                            {
+                                "timestamp": measure_timestamp,
+                                "value": measure_value,
+                                "period": period,
+                                "_t": "it.bz.idm.bdp.dto.SimpleRecordDto"
+                            }
+                            for measure_timestamp, measure_value in records
+                        ]
+                    }
+                },
+                "data": []
+            }
+        },
+        "data": [],
+        "provenance": provenance_id
+    }
 
-def get_availability_percentage(host, station_name, last_hours):
-    # API info
-    station_type = "EChargingStation"
+    return push_records(host, auth_token, station_type, data_tree)
 
-    
-    # Define the time range for the last hour
+def daily_pushes(days, pushed_day, now_ms):
+    """The (day, timestamp) pairs a run pushes daily values for: today's so far, stamped with now_ms.
+
+    BDP skips records that aren't newer than the latest one of the station,
+    so on the first run of a day the final values of the days since the last
+    push (pushed_day) go first, stamped with the last millisecond of their day.
+    """
+    today = day_key(now_ms)
+    closed_days = [day for day in sorted(days) if pushed_day is not None and pushed_day <= day < today]
+    return [(day, day_end_ms(day)) for day in closed_days] + [(today, now_ms)]
+
+def push_daily_counts(host, auth_token, provenance_id, station_type, event_state, now_ms):
+    """Push the charging event counts per day, see daily_pushes. The day of the last push is kept in the event state."""
+    for day, pushed_ms in daily_pushes(event_state["daily"], event_state.get("pushed_day"), now_ms):
+        for station_id, count in daily_event_counts(event_state, day).items():
+            add_station_records(host, auth_token, provenance_id, station_type, station_id, "charging-events", [(pushed_ms, count)], period=86400)
+    event_state["pushed_day"] = day_key(now_ms)
+
+def push_daily_durations(host, auth_token, provenance_id, station_type, totals, now_ms):
+    """Push the average charging durations per day, see daily_pushes. The day of the last push is kept in the session totals."""
+    for day, pushed_ms in daily_pushes(totals["days"], totals.get("pushed_day"), now_ms):
+        for station_id, minutes in daily_average_durations(totals, day).items():
+            add_station_records(host, auth_token, provenance_id, station_type, station_id, "charging-duration", [(pushed_ms, minutes)], period=86400)
+    totals["pushed_day"] = day_key(now_ms)
+
+def push_hourly_buckets(host, auth_token, provenance_id, station_type, closed):
+    """Push the closed hourly buckets (see hourly_buckets) as availability-hourly, one request per station."""
+    records = {}
+    for station_id, hour, value, samples, coverage in closed:
+        if value is not None:
+            records.setdefault(station_id, []).append((hour, value))
+    for station_id, station_records in records.items():
+        response = add_station_records(host, auth_token, provenance_id, station_type, station_id, "availability-hourly", station_records, period=3600)
+        if response.status_code >= 400:
+            print(f"Error pushing hourly availability of {station_id}: {response.status_code}")
+
+from datetime import datetime, timedelta
+
+def get_time_window(last_hours):
+    """Return the formatted (from_date, to_date) for the last hours, in UTC."""
     end_time = datetime.now(timezone.utc)
     start_time = end_time - timedelta(hours=last_hours)
-    
+
     # Format the timestamps
     from_date = start_time.strftime("%Y-%m-%dT%H:%M:%S")
     to_date = end_time.strftime("%Y-%m-%dT%H:%M:%S")
+    return from_date, to_date
+
+def compute_availability_percentage(data):
+    """Percentage of the measurements in data (rows or a StationSeries) with a value > 0."""
+    total_entries= 0
+    available_entries = 0
+
+    for mvalue in measurement_values(data):
+        total_entries += 1
+        if mvalue > 0:
+            available_entries += 1
+
+    if total_entries > 0:
+        availability_percentage = (available_entries / total_entries) * 100
+        return availability_percentage
+    else:
+        return 0  # No data available
+
+def compute_used_charging(data):
+    """Number of measurements in data (rows or a StationSeries) with a value > 0.
+
+    This counts samples, not charging sessions, see charging_events for those.
+    """
+    used_charging = 0
+
+    for mvalue in measurement_values(data):
+        if mvalue and mvalue > 0:
+            used_charging += 1
+
+    return used_charging
+
+def get_availability_percentage(host, station_name, last_hours):
+    # API info
+    station_type = "EChargingStation"
+
+    # Define the time range for the last hour
+    from_date, to_date = get_time_window(last_hours)
     
     # Call the API to get charging station status
-    response = get_charging_stations_status(host, station_type, from_date, to_date, station_name)
+    response = get_charging_stations_status(host, station_type, from_date, to_date, station_name, AVAILABILITY_DATATYPES)
     
     if response.status_code == 200:
-        data = response.json()['data']
-        
-        total_entries= 0
-        available_entries = 0
-        
-        for entry in data:
-            total_entries += 1
-            mvalue = entry.get('mvalue')
-            if mvalue > 0:
-                available_entries += 1
-        
-        if total_entries > 0:
-            availability_percentage = (available_entries / total_entries) * 100
-            return availability_percentage
-        else:
-            return 0  # No data available
+        rows, size = decode_rows(response, fields=['mvalue'], row_type="record")
+        return compute_availability_percentage(rows)
     else:
+        response.close()
         return 0  # No data available
     
 def get_all_charging_stations_names():
-    url='https://mobility.api.opendatahub.com/v2/flat/EChargingStation/number-available/latest?select=scode&limit=-1&offset=0&where=sactive.eq.true&shownull=false&distinct=true'
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()['data']
-        names = [entry['scode'] for entry in data]
-        return names
-    else:
-        print(f"Error fetching data for stations names: {response.status_code}")
+    url = 'https://mobility.api.opendatahub.com/v2/flat/EChargingStation/number-available/latest?select=scode&limit={limit}&offset={offset}&where=sactive.eq.true&shownull=false&distinct=true'
+    names = []
+    try:
+        for data in iter_pages(lambda limit, offset: url.format(limit=limit, offset=offset), fields=['scode']):
+            names.extend(entry['scode'] for entry in data)
+    except requests.RequestException as e:
+        print(f"Error fetching data for stations names: {e}")
         return None
+    return names
 
+def build_metrics(names):
+    """The metrics pushed for every station, see query_planner."""
+    return [
+        declare_metric("availability", compute_time_weighted_availability, AVAILABILITY_DATATYPE, 1, names, kernel="time_weighted_availability", carry_in=True),
+        declare_metric("usage", compute_used_charging, AVAILABILITY_DATATYPE, 24, names, kernel="used_charging")
+    ]
+
+def process_station(write_host, auth_token, provenance_id, origin, station_type, name, values, catalog=None):
+    """Sync the station (with its facts from the catalog) and push its metric values."""
+    station = get_station(catalog, name) if catalog is not None else None
+    if station is not None:
+        upsert_station(write_host, auth_token, origin, station_type, name, station["name"], station["latitude"], station["longitude"], 0, station["municipality"])
+    else:
+        upsert_station(write_host, auth_token, origin, station_type, name, name, None, None, 0, None)
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    for metric_name, value in values.items():
+        add_station_data(write_host, auth_token, provenance_id, station_type, name, round(time.time() * 1000), metric_name, value)
+        print(f"Station {name} {metric_name}: {value}")
+    return {'scode': name, 'timestamp': timestamp, **values}
+
+def plan_station_batches(read_host, station_type, metrics, store):
+    """Plan the fetches of the metrics (see plan_queries and plan_incremental_fetch).
+
+    Returns the batches to fetch as (datatype, plan, from_date, to_date, batch)
+    tuples, and for every station the number of batches it is waiting for.
+    """
+    batches = []
+    pending = {}
+    for query in plan_queries(metrics):
+        datatype = query["datatype"]
+        plan = plan_incremental_fetch(store, query["station_ids"], datatype, query["window_hours"], query["retain_hours"])
+        to_date = format_query_date(plan["now_ms"])
+        for from_ms, stations in plan["fetches"]:
+            from_date = format_query_date(from_ms)
+            for batch in batch_station_ids(read_host, station_type, from_date, to_date, stations, datatypes=[datatype]):
+                batches.append((datatype, plan, from_date, to_date, batch))
+                for name in batch:
+                    pending[name] = pending.get(name, 0) + 1
+    return batches, pending
+
+def fetch_station_batch(read_host, station_type, batch_item, cache=None, failed=None):
+    """Fetch a planned batch, through the range cache if there is one. Stations that couldn't be fetched are added to failed."""
+    datatype, plan, from_date, to_date, batch = batch_item
+    if cache is None:
+        return get_charging_stations_status_batch(read_host, station_type, from_date, to_date, batch, [datatype], failed=failed)
+    return get_charging_stations_status_cached(read_host, station_type, from_date, to_date, batch, datatype, cache, failed=failed)
+
+def merge_station_batch(store, shared, pending, batch_item, series, failed):
+    """Merge a fetched batch into the store and the shared series. Returns the stations that have all their data now.
+
+    Stations in failed (of any of their batches) are neither merged nor
+    returned, so they aren't processed with stale data and get fetched again
+    by the next run.
+    """
+    datatype, plan, from_date, to_date, batch = batch_item
+    fetched = [name for name in batch if name not in failed]
+    for name, station_series in merge_incremental_fetch(store, plan, datatype, fetched, series).items():
+        shared.put(name, datatype, station_series)
+    ready = []
+    for name in batch:
+        pending[name] -= 1
+        if pending[name] == 0 and name not in failed:
+            ready.append(name)
+    return ready
+
+def print_failed_stations(failed):
+    if failed:
+        print(f"{len(failed)} stations couldn't be fetched, they are left out and fetched again next run: {', '.join(sorted(failed))}")
+
+def print_dropped_stations(pending, failed, results):
+    """Report the stations that were fetched but have no result, because a later step failed."""
+    dropped = sorted(set(pending) - failed - {result['scode'] for result in results})
+    if dropped:
+        print(f"{len(dropped)} stations dropped by pipeline errors: {', '.join(dropped)}")
+
+async def process_stations_async(client, read_host, write_host, auth_token, provenance_id, origin, station_type, metrics, store, catalog=None, cache=None):
+    """Fetch what the metrics need and process the stations, with the batches and the stations running concurrently.
+
+    A station is processed as soon as all of its batches are in. With a
+    cache (see range_cache), the history is fetched through it. Like the
+    staged pipeline, a batch or station that fails is reported and left out,
+    the other stations still return their results.
+    """
+    shared = SeriesBatch()
+    processing = []
+    failed = set()
+    batches, pending = plan_station_batches(read_host, station_type, metrics, store)
+
+    async def fetch_batch(batch_item):
+        datatype, plan, from_date, to_date, batch = batch_item
+        batch_failed = []
+        series = await client.call(read_host, fetch_station_batch, read_host, station_type, batch_item, cache, batch_failed)
+        failed.update(batch_failed)
+        ready = merge_station_batch(store, shared, pending, batch_item, series, failed)
+        # The stations that are ready are computed together by the metric engine
+        for name, values in compute_metrics(metrics, shared.select(ready), plan["now_ms"], ready).items():
+            processing.append((name, asyncio.ensure_future(client.call(write_host, process_station, write_host, auth_token, provenance_id, origin, station_type, name, values, catalog))))
+
+    for batch_item, outcome in zip(batches, await asyncio.gather(*(fetch_batch(batch_item) for batch_item in batches), return_exceptions=True)):
+        if isinstance(outcome, Exception):
+            print(f"Error fetching a batch of {len(batch_item[4])} stations: {outcome}")
+    print_failed_stations(failed)
+    results = []
+    for (name, future), outcome in zip(processing, await asyncio.gather(*(future for name, future in processing), return_exceptions=True)):
+        if isinstance(outcome, Exception):
+            print(f"Error processing station {name}: {outcome}")
+        else:
+            results.append(outcome)
+    print_dropped_stations(pending, failed, results)
+    return results
+
+def process_stations(read_host, write_host, auth_token, provenance_id, origin, station_type, metrics, store, catalog=None, cache=None, concurrency=DEFAULT_CONCURRENCY):
+    """Sync facade of process_stations_async, returns the results of all stations."""
+    return run_sync(process_stations_async, read_host, write_host, auth_token, provenance_id, origin, station_type, metrics, store, catalog, cache, concurrency=concurrency)
+
+def process_stations_staged(read_host, write_host, auth_token, provenance_id, origin, station_type, metrics, store, catalog=None, cache=None, fetch_workers=FETCH_WORKERS, compute_workers=COMPUTE_WORKERS, write_workers=WRITE_WORKERS, report_every=None):
+    """Same as process_stations, as a threaded fetch -> compute -> write pipeline.
+
+    Each stage has its own thread pool, and the bounded queues between them
+    keep the fetch stage from running ahead of a slow BDP. The fetch stage
+    hands the compute stage a snapshot of the stations that have all their
+    data, so computing doesn't hold the lock of the shared series.
+    """
+    shared = SeriesBatch()
+    lock = threading.Lock()
+    failed = set()
+    batches, pending = plan_station_batches(read_host, station_type, metrics, store)
+
+    def fetch(batch_item):
+        datatype, plan, from_date, to_date, batch = batch_item
+        batch_failed = []
+        series = fetch_station_batch(read_host, station_type, batch_item, cache, batch_failed)
+        with lock:
+            failed.update(batch_failed)
+            ready = merge_station_batch(store, shared, pending, batch_item, series, failed)
+            return [(ready, shared.select(ready), plan["now_ms"])] if ready else []
+
+    def compute(item):
+        ready, snapshot, now_ms = item
+        return list(compute_metrics(metrics, snapshot, now_ms, ready).items())
+
+    def write(item):
+        name, values = item
+        return [process_station(write_host, auth_token, provenance_id, origin, station_type, name, values, catalog)]
+
+    pipeline = StagedPipeline([
+        ("fetch", fetch, fetch_workers),
+        ("compute", compute, compute_workers),
+        ("write", write, write_workers)
+    ])
+    results = pipeline.run(batches, report_every)
+    pipeline.print_queue_depths()
+    print_failed_stations(failed)
+    print_dropped_stations(pending, failed, results)
+    return results
 
 def main():
     read_host = "https://mobility.api.opendatahub.com/v2/flat%2Cnode"
@@ -238,6 +508,10 @@ def main():
     station_type = "EChargingStation"
     origin = "SlowCharging"
 
+    # Connection pools fit the concurrency of the pipeline, sized before any thread uses them.
+    # Reads are bounded by the rate limiter instead, see odh_client.set_pool_size.
+    set_pool_size(max(DEFAULT_CONCURRENCY, WRITE_WORKERS))
+
     #1 Get the authentication token
     auth_token = get_auth_token()
     
@@ -255,6 +529,10 @@ def main():
 
         provenance_id = response.text
         response = upsert_datatype(write_host, auth_token, prn, prv, "availability", "%")
+        response = upsert_datatype(write_host, auth_token, prn, prv, "usage", "times")
+        response = upsert_datatype(write_host, auth_token, prn, prv, "availability-hourly", "%")
+        response = upsert_datatype(write_host, auth_token, prn, prv, "charging-events", "times")
+        response = upsert_datatype(write_host, auth_token, prn, prv, "charging-duration", "min")
         print_response_details("#3 Sync Data Types", response)
         
         #response = upsert_station(write_host, auth_token, origin, station_type, "ASM_00000181", "MORI_01", 46.333, 11.356, 0, "Bolzano")
@@ -267,23 +545,87 @@ def main():
         # # http://localhost:8082/flat,node/EChargingStation/
         # # http://localhost:8082/flat,node/EChargingStation/*/latest
         
-    results = []
-    names = get_all_charging_stations_names()
-
-    for name in names:
-        upsert_station(write_host, auth_token, origin, station_type, name, "MORI_01", 46.333, 11.356, 0, "Bolzano")
-        availability = get_availability_percentage(read_host, name, 1)
-        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
-        results.append({'scode': name, 'availability': availability, 'timestamp': timestamp})
-        response = add_station_data(write_host, auth_token, provenance_id, station_type, name, round(time.time() * 1000), "availability", availability)
-        print(f"Station {name} available: {availability}%.")
-        
-    total_percentage = 0
-    for result in results:
-        total_percentage += result['availability']  # Corrected accessing 'availability' from each result
-
-    average_availability = total_percentage / len(results)
-    print(f"Average availability: {average_availability}%")
+    try:
+        latest = get_latest_measurements(read_host, station_type, AVAILABILITY_DATATYPE)
+    except requests.RequestException as e:
+        print(f"Error fetching the latest measurements: {e}")
+        return
+    names = list(latest)
+    if not names:
+        print("No active stations")
+        return
+
+    # Station facts (name, coordinates, municipality) come from the catalog,
+    # which only asks Ninja for stations it doesn't know yet
+    try:
+        catalog = get_catalog(read_host, station_type, names)
+    except requests.RequestException as e:
+        print(f"Error updating the station catalog, using the stored one: {e}")
+        catalog = load_catalog()
+
+    # Only stations whose latest measurement changed since the previous run are
+    # fetched and recomputed, the others keep their previous results
+    store = load_history_store()
+    # Everything fetched is also kept in the range cache, so re-runs after a
+    # lost store and backfills read it from disk instead of Ninja
+    cache = open_range_cache()
+    changed, unchanged = detect_changes(store, latest, AVAILABILITY_DATATYPE)
+    print(f"{len(changed)} stations changed, {len(unchanged)} unchanged")
+
+    # Fetch what the metrics need with one shared set of queries, only downloading
+    # the measurements that are newer than what the previous runs already stored,
+    # and process the stations concurrently
+    metrics = build_metrics(changed)
+    if PIPELINE_MODE == "staged":
+        results = process_stations_staged(read_host, write_host, auth_token, provenance_id, origin, station_type, metrics, store, catalog, cache, report_every=10)
+    else:
+        results = process_stations(read_host, write_host, auth_token, provenance_id, origin, station_type, metrics, store, catalog, cache)
+    # Stations that couldn't be fetched have no result, so they aren't
+    # remembered and count as changed next run
+    remember_results(store, latest, AVAILABILITY_DATATYPE, results)
+    results += get_previous_results(store, unchanged)
+
+    # Hourly availability of the whole network in one pass over the measurements
+    # this run added to the store. The hour every station is in stays open in
+    # the hourly state, so no hour is ever aggregated twice.
+    hourly_state = load_hourly_state()
+    closed = aggregate_hourly(hourly_state, new_store_measurements(hourly_state, store, names, AVAILABILITY_DATATYPE), AVAILABILITY_DATATYPE, round(time.time() * 1000), station_ids=names)
+    push_hourly_buckets(write_host, auth_token, provenance_id, station_type, closed)
+    print(f"{len(closed)} hourly buckets closed")
+    save_hourly_state(hourly_state)
+    save_history_store(store)
+
+    # Charging events (a plug going from free to occupied) and the average
+    # duration of the charging sessions of today, from the plug statuses since
+    # the previous run
+    event_state = load_event_state()
+    session_totals = load_session_totals()
+    try:
+        events, sessions = update_charging_sessions(read_host, event_state, session_totals)
+    except requests.RequestException as e:
+        print(f"Error reading the plug statuses: {e}")
+    else:
+        print(f"{len(events)} charging events and {len(sessions)} finished sessions since the previous run")
+        pushed_ms = round(time.time() * 1000)
+        push_daily_counts(write_host, auth_token, provenance_id, station_type, event_state, pushed_ms)
+        push_daily_durations(write_host, auth_token, provenance_id, station_type, session_totals, pushed_ms)
+        save_event_state(event_state)
+        save_session_totals(session_totals)
+
+    # Availability is time weighted, which Ninja can't aggregate, so the
+    # average comes from the station results
+    if results:
+        total_percentage = 0
+        for result in results:
+            total_percentage += result['availability']  # Corrected accessing 'availability' from each result
+        average_availability = total_percentage / len(results)
+        print(f"Average availability: {average_availability}%")
+
+    from_date, to_date = get_time_window(1)
+    projection_ratio = get_projection_ratio(read_host, station_type, from_date, to_date, names, AVAILABILITY_DATATYPES)
+    print_read_stats(projection_ratio)
+    print_limiter_stats()
+    print_request_stats()
 
 if __name__=="__main__":
     main()
@@ -0,0 +1,55 @@
+import time
+
+from ninja_reader import iter_pages
+from timestamps import parse_mvalidtime
+from history_store import history_key
+
+# Results older than this are recomputed even if the station didn't change,
+# so the sliding metric windows don't go stale forever
+MAX_RESULT_AGE_MS = 3600 * 1000
+
+def get_latest_measurements(host, station_type, datatype):
+    """The latest measurement of every active station, as {scode: [epoch ms, mvalue]}. One request per page."""
+    url = f"{host}/{station_type}/{datatype}/latest?select=scode,mvalidtime,mvalue&limit={{limit}}&offset={{offset}}&where=sactive.eq.true&shownull=false&distinct=true"
+    latest = {}
+    for data in iter_pages(lambda limit, offset: url.format(limit=limit, offset=offset), fields=['scode', 'mvalidtime', 'mvalue']):
+        for entry in data:
+            latest[entry['scode']] = [parse_mvalidtime(entry['mvalidtime']), entry.get('mvalue')]
+    return latest
+
+def detect_changes(store, latest, datatype, now_ms=None, max_age_ms=MAX_RESULT_AGE_MS):
+    """Split the stations of latest into the ones to recompute and the ones that can keep their previous results.
+
+    A station is unchanged if its latest measurement is the one seen by the
+    previous run and its stored results are younger than max_age_ms.
+    Returns (changed, unchanged) lists of station codes.
+    """
+    if now_ms is None:
+        now_ms = round(time.time() * 1000)
+    seen = store.get("latest", {})
+    results = store.get("results", {})
+    changed = []
+    unchanged = []
+    for station_id, measurement in latest.items():
+        previous = results.get(station_id)
+        if seen.get(history_key(station_id, datatype)) == measurement and previous and now_ms - previous["computed_ms"] < max_age_ms:
+            unchanged.append(station_id)
+        else:
+            changed.append(station_id)
+    return changed, unchanged
+
+def remember_results(store, latest, datatype, results, now_ms=None):
+    """Store the latest measurements and the results of the recomputed stations for the next run's detect_changes."""
+    if now_ms is None:
+        now_ms = round(time.time() * 1000)
+    seen = store.setdefault("latest", {})
+    stored = store.setdefault("results", {})
+    for result in results:
+        station_id = result['scode']
+        if station_id in latest:
+            seen[history_key(station_id, datatype)] = latest[station_id]
+        stored[station_id] = {"computed_ms": now_ms, "result": result}
+
+def get_previous_results(store, station_ids):
+    """The stored results of stations, as returned by process_station."""
+    return [store["results"][station_id]["result"] for station_id in station_ids]
@@ -0,0 +1,145 @@
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import requests
+
+from ninja_reader import format_query_date, iter_pages
+from timestamps import parse_mvalidtime
+from plug_poller import OCCUPIED, PLUG_STATION_TYPE, PLUG_STATUS_DATATYPE, plug_state
+
+# Where the plug states and daily counts are kept between runs
+EVENTS_STATE_PATH = "state/charging_events.json"
+
+# A first run starts this far back, the plugs seen there only start being tracked
+FIRST_RUN_HOURS = 1
+
+# Every run reads again this much before the end of the previous one, for
+# measurements that showed up in Ninja late. Those already seen are skipped.
+OVERLAP_MS = 15 * 60 * 1000
+
+# Daily counts older than this are dropped
+RETAIN_DAYS = 7
+
+PLUG_SELECT = "scode,pcode,mvalidtime,mvalue"
+
+def new_event_state():
+    """Last state and measurement time of every plug, and the event counts per day and station.
+
+    plugs maps a plug code to {"state", "time_ms", "station", "since_ms"},
+    since_ms being when the plug got into its state (None if it already was
+    when first seen). An occupied plug with a since_ms is an open charging
+    session, see charging_sessions.
+    """
+    return {"fetched_ms": None, "plugs": {}, "daily": {}}
+
+def load_event_state(path=EVENTS_STATE_PATH):
+    if not os.path.exists(path):
+        return new_event_state()
+    with open(path) as f:
+        return json.load(f)
+
+def save_event_state(state, path=EVENTS_STATE_PATH):
+    """Write the state to a temporary file first, so a crashed run never leaves a half written one."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def day_key(epoch_ms):
+    """The UTC day of a timestamp, as YYYY-MM-DD."""
+    return datetime.fromtimestamp(epoch_ms / 1000, timezone.utc).strftime("%Y-%m-%d")
+
+def day_end_ms(day):
+    """The last millisecond of a UTC day (YYYY-MM-DD)."""
+    return round(datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() * 1000) + 24 * 3600 * 1000 - 1
+
+def add_status(state, plug, station, time_ms, mvalue, sessions=None):
+    """Feed one status measurement of a plug. Returns True if the plug went from free to occupied.
+
+    Measurements at or before the last one of the plug are skipped. A plug
+    seen for the first time only starts being tracked. A plug getting free
+    after a charging event closes its session, which is appended to sessions
+    as (plug, station, start ms, end ms).
+    """
+    status = plug_state(mvalue)
+    known = state["plugs"].get(plug)
+    if known is None:
+        state["plugs"][plug] = {"state": status, "time_ms": time_ms, "station": station, "since_ms": None}
+        return False
+    if time_ms <= known["time_ms"]:
+        return False
+    changed = known["state"] != status
+    if changed and status != OCCUPIED and known.get("since_ms") is not None and sessions is not None:
+        sessions.append((plug, known["station"], known["since_ms"], time_ms))
+    known["time_ms"] = time_ms
+    known["station"] = station
+    if not changed:
+        return False
+    known["state"] = status
+    known["since_ms"] = time_ms
+    if status == OCCUPIED:
+        counts = state["daily"].setdefault(day_key(time_ms), {})
+        counts[station] = counts.get(station, 0) + 1
+    return status == OCCUPIED
+
+def detect_events(state, rows, sessions=None):
+    """Feed status rows (scode, pcode, mvalidtime, mvalue) of any plugs. Returns the charging events as (plug, station, time ms)."""
+    events = []
+    rows = sorted(((parse_mvalidtime(row['mvalidtime']), row) for row in rows), key=lambda timed: timed[0])
+    for time_ms, row in rows:
+        station = row.get('pcode', row['scode'])
+        if add_status(state, row['scode'], station, time_ms, row.get('mvalue'), sessions):
+            events.append((row['scode'], station, time_ms))
+    return events
+
+def expire_days(state, now_ms, retain_days=RETAIN_DAYS):
+    oldest = day_key(now_ms - retain_days * 24 * 3600 * 1000)
+    for day in [day for day in state["daily"] if day < oldest]:
+        del state["daily"][day]
+
+def iter_plug_statuses(host, from_ms, to_ms):
+    """Yield the status measurements of all active plugs in [from_ms, to_ms), page by page."""
+    url = f"{host}/{PLUG_STATION_TYPE}/{PLUG_STATUS_DATATYPE}/{format_query_date(from_ms)}/{format_query_date(to_ms)}?select={PLUG_SELECT}&limit={{limit}}&offset={{offset}}&where=sactive.eq.true&shownull=false&timezone=UTC"
+    yield from iter_pages(lambda limit, offset: url.format(limit=limit, offset=offset), fields=PLUG_SELECT.split(","))
+
+def update_charging_events(host, state, now_ms=None, sessions=None):
+    """Read the plug statuses since the previous run and detect the charging events in them.
+
+    Only the new measurements are read, the state stays one entry per plug
+    (plus the daily counts). Returns the events of this run, the sessions
+    that ended are appended to sessions.
+    """
+    if now_ms is None:
+        now_ms = round(time.time() * 1000)
+    from_ms = now_ms - FIRST_RUN_HOURS * 3600 * 1000 if state["fetched_ms"] is None else state["fetched_ms"] - OVERLAP_MS
+    events = []
+    for data in iter_plug_statuses(host, from_ms, now_ms):
+        events += detect_events(state, data, sessions)
+    state["fetched_ms"] = now_ms
+    expire_days(state, now_ms)
+    return events
+
+def daily_event_counts(state, day):
+    """Charging events of every station on a day (YYYY-MM-DD), as {station: count}."""
+    return dict(state["daily"].get(day, {}))
+
+def main():
+    read_host = "https://mobility.api.opendatahub.com/v2/flat%2Cnode"
+    state = load_event_state()
+    try:
+        events = update_charging_events(read_host, state)
+    except requests.RequestException as e:
+        print(f"Error reading the plug statuses: {e}")
+        return
+    save_event_state(state)
+    print(f"{len(events)} charging events, {len(state['plugs'])} plugs tracked")
+    for station, count in sorted(daily_event_counts(state, day_key(round(time.time() * 1000))).items()):
+        print(f"Station {station} today: {count} charging events")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import csv
+import json
+import os
+import time
+
+import requests
+
+from charging_events import day_key, load_event_state, save_event_state, update_charging_events
+from plug_poller import OCCUPIED
+
+# The finished sessions, one (plug, station, start ms, end ms) line each,
+# only ever appended to
+SESSIONS_PATH = "state/sessions.csv"
+
+# Daily duration totals, and how far into the session table they are
+SESSION_TOTALS_PATH = "state/session_totals.json"
+
+def append_sessions(sessions, path=SESSIONS_PATH):
+    """Append finished sessions to the session table."""
+    if not sessions:
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if os.path.exists(path):
+        with open(path, "rb+") as f:
+            # Drop a line half written by a crashed run, the next one starts clean
+            size = f.seek(0, os.SEEK_END)
+            tail_start = max(0, size - 4096)
+            f.seek(tail_start)
+            tail = f.read()
+            if tail and not tail.endswith(b"\n"):
+                f.truncate(tail_start + tail.rfind(b"\n") + 1)
+    with open(path, "a", newline="") as f:
+        csv.writer(f, lineterminator="\n").writerows(sessions)
+
+def read_sessions(path=SESSIONS_PATH, offset=0):
+    """Yield the sessions of the table from a byte offset on, as ((plug, station, start ms, end ms), offset after it)."""
+    if not os.path.exists(path):
+        return
+    with open(path, newline="") as f:
+        f.seek(offset)
+        # readline instead of iterating, which keeps tell() usable
+        for line in iter(f.readline, ""):
+            if not line.endswith("\n"):
+                # Half written by a crashed run
+                return
+            plug, station, start_ms, end_ms = next(csv.reader([line]))
+            yield (plug, station, int(start_ms), int(end_ms)), f.tell()
+
+def new_session_totals():
+    """Number and total duration of the sessions per day (of their end) and station.
+
+    days maps a day (YYYY-MM-DD) to {station: [count, total ms]}, offset is
+    the byte offset in the session table up to which the sessions are counted.
+    A session is counted on the day it ends, so an overnight session lands in
+    a day that is still pushed, see average_availability.push_daily_durations.
+    """
+    return {"offset": 0, "days": {}}
+
+def load_session_totals(path=SESSION_TOTALS_PATH):
+    if not os.path.exists(path):
+        return new_session_totals()
+    with open(path) as f:
+        return json.load(f)
+
+def save_session_totals(totals, path=SESSION_TOTALS_PATH):
+    """Write the totals to a temporary file first, so a crashed run never leaves half written ones."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(totals, f)
+    os.replace(tmp_path, path)
+
+def update_session_totals(totals, path=SESSIONS_PATH):
+    """Add the sessions appended to the table since the last update to the totals. Returns how many were added."""
+    added = 0
+    for (plug, station, start_ms, end_ms), offset in read_sessions(path, totals["offset"]):
+        station_totals = totals["days"].setdefault(day_key(end_ms), {}).setdefault(station, [0, 0])
+        station_totals[0] += 1
+        station_totals[1] += end_ms - start_ms
+        totals["offset"] = offset
+        added += 1
+    return added
+
+def daily_average_durations(totals, day):
+    """Average charging duration in minutes of every station on a day (YYYY-MM-DD), as {station: minutes}."""
+    return {station: total_ms / count / 60000 for station, (count, total_ms) in totals["days"].get(day, {}).items()}
+
+def open_sessions(event_state):
+    """The sessions still going on, as {plug: (station, start ms)}. They are part of the plug states, see charging_events."""
+    return {plug: (known["station"], known["since_ms"]) for plug, known in event_state["plugs"].items() if known["state"] == OCCUPIED and known.get("since_ms") is not None}
+
+def update_charging_sessions(host, event_state, totals, now_ms=None, path=SESSIONS_PATH):
+    """Read the plug statuses since the previous run, append the sessions that ended to the table and update the totals.
+
+    A session still open at the end of the run stays in the plug state and is
+    closed by a later run, without reading the data it started in again.
+    Returns the events and the sessions of this run.
+    """
+    sessions = []
+    events = update_charging_events(host, event_state, now_ms, sessions)
+    append_sessions(sessions, path)
+    update_session_totals(totals, path)
+    return events, sessions
+
+def main():
+    read_host = "https://mobility.api.opendatahub.com/v2/flat%2Cnode"
+    event_state = load_event_state()
+    totals = load_session_totals()
+    try:
+        events, sessions = update_charging_sessions(read_host, event_state, totals)
+    except requests.RequestException as e:
+        print(f"Error reading the plug statuses: {e}")
+        return
+    save_event_state(event_state)
+    save_session_totals(totals)
+    print(f"{len(sessions)} sessions ended, {len(open_sessions(event_state))} still open")
+    for station, minutes in sorted(daily_average_durations(totals, day_key(round(time.time() * 1000))).items()):
+        print(f"Station {station} today: {minutes:.1f} minutes per session")
+
+if __name__ == "__main__":
+    main()
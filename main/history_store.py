@@ -0,0 +1,214 @@
+import json
+import os
+import time
+from bisect import bisect_left
+from urllib.parse import quote
+
+from ninja_reader import DEFAULT_SELECT, format_query_date, get_charging_stations_status_batch
+from series import StationSeries
+from timestamps import parse_mvalidtime
+
+# Where the high water marks are kept between runs. The retained history is
+# kept next to it, in append-only columns per station and data type (see
+# save_history_store), so a run only writes what it fetched.
+HISTORY_STORE_PATH = "state/history.json"
+
+# Warm stations are grouped by how long ago their high water mark is, in
+# doubling steps from this age on. A group's fetch starts at its oldest mark,
+# so no station fetches more than about twice the time it missed.
+WARM_GROUP_MIN_AGE_MS = 5 * 60 * 1000
+
+# Store keys that only live in memory during a run
+RUN_KEYS = ["path", "series", "appended", "replaced"]
+
+def new_history_store(path=HISTORY_STORE_PATH):
+    """An empty store.
+
+    hwm maps station/datatype to the newest measurement time seen, columns
+    to the column files of its retained history: their generation and the
+    [start, end) of the measurements still retained in them.
+    """
+    return {"hwm": {}, "columns": {}, "path": os.path.splitext(path)[0], "series": {}, "appended": {}, "replaced": []}
+
+def load_history_store(path=HISTORY_STORE_PATH):
+    """Load the high water marks of the previous runs. The retained history is only read when it's used."""
+    store = new_history_store(path)
+    if os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+        # A store from before the columns had its rows in the JSON, it's fetched again
+        if "rows" not in saved:
+            store.update(saved)
+    return store
+
+def column_paths(store, key, generation):
+    directory = os.path.join(store["path"], quote(key, safe=''))
+    return os.path.join(directory, f"{generation}.i64"), os.path.join(directory, f"{generation}.f64")
+
+def write_columns(store, key, series, offset, generation):
+    """Write series to the column files of a generation from measurement offset on, cutting off anything after it."""
+    for path, column in zip(column_paths(store, key, generation), (series.times, series.values)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "ab") as f:
+            f.truncate(offset * column.itemsize)
+            column.tofile(f)
+
+def save_history_store(store, path=HISTORY_STORE_PATH):
+    """Append the measurements merged by this run to the columns, then write the high water marks.
+
+    Measurements in the column files after the end in the JSON (written by a
+    run that crashed before the JSON) are cut off by the next append. A
+    column whose expired part outgrew the retained one is written to a new
+    generation, the old files are removed once the JSON points to it.
+    """
+    for key, appended in store["appended"].items():
+        series = store["series"][key]
+        entry = store["columns"].setdefault(key, {"generation": 0, "start": 0, "end": 0})
+        if entry["start"] > len(series):
+            store["replaced"].append((key, entry["generation"]))
+            entry.update(generation=entry["generation"] + 1, start=0, end=0)
+            appended = len(series)
+        if appended:
+            tail = series.slice(series.times[len(series) - appended])
+            write_columns(store, key, tail, entry["end"], entry["generation"])
+            entry["end"] += appended
+    store["appended"] = {}
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({key: value for key, value in store.items() if key not in RUN_KEYS}, f)
+    os.replace(tmp_path, path)
+
+    for key, generation in store["replaced"]:
+        for column_path in column_paths(store, key, generation):
+            if os.path.exists(column_path):
+                os.remove(column_path)
+    store["replaced"] = []
+
+def history_key(station_id, datatype):
+    return f"{station_id}/{datatype}"
+
+def row_time(row):
+    return parse_mvalidtime(row['mvalidtime'])
+
+def get_high_water_mark(store, station_id, datatype):
+    """Epoch milliseconds of the newest measurement seen for the station and data type, or None."""
+    return store["hwm"].get(history_key(station_id, datatype))
+
+def read_columns(store, key):
+    """The retained history of a key as a StationSeries, read from its columns once per run."""
+    series = store["series"].get(key)
+    if series is not None:
+        return series
+    series = StationSeries()
+    entry = store["columns"].get(key)
+    if entry is not None and entry["end"] > entry["start"]:
+        for path, column in zip(column_paths(store, key, entry["generation"]), (series.times, series.values)):
+            with open(path, "rb") as f:
+                f.seek(entry["start"] * column.itemsize)
+                column.fromfile(f, entry["end"] - entry["start"])
+    store["series"][key] = series
+    return series
+
+def merge_rows(store, station_id, datatype, rows, retain_from_ms):
+    """Merge newly fetched rows (or a StationSeries) into the retained history and advance the high water mark.
+
+    Measurements at or before the high water mark were already merged by an
+    earlier run and are dropped. Retained measurements older than
+    retain_from_ms are expired. Returns the retained history as a StationSeries.
+    """
+    key = history_key(station_id, datatype)
+    hwm = store["hwm"].get(key)
+    retained = read_columns(store, key)
+    appended = store["appended"].get(key, 0)
+
+    # The retained measurements are kept oldest first, so only the expired ones have to be looked at
+    expired = bisect_left(retained.times, retain_from_ms)
+    if expired:
+        retained = store["series"][key] = retained.slice(retain_from_ms)
+        appended = min(appended, len(retained))
+        if key in store["columns"]:
+            store["columns"][key]["start"] += expired
+
+    new = rows if isinstance(rows, StationSeries) else StationSeries.from_rows(sorted(rows, key=row_time))
+    for time_ms, value in zip(new.times, new.values):
+        if hwm is None or time_ms > hwm:
+            retained.append(time_ms, value)
+            appended += 1
+            hwm = time_ms
+
+    if appended:
+        store["appended"][key] = appended
+    if hwm is not None:
+        store["hwm"][key] = hwm
+    return retained
+
+def get_window_series(store, station_id, datatype, from_ms):
+    """Retained history of the station and data type from from_ms on, as a StationSeries."""
+    return read_columns(store, history_key(station_id, datatype)).slice(from_ms)
+
+def plan_incremental_fetch(store, station_ids, datatype, window_hours, retain_hours=None):
+    """Work out which ranges an incremental run has to fetch.
+
+    Stations seen by an earlier run are fetched from their high water mark on,
+    in groups of similar high water marks (see WARM_GROUP_MIN_AGE_MS), new
+    ones (or ones that fell out of the window) over the full window.
+    Rows are kept for retain_hours (at least window_hours), so metrics with
+    different windows can share the store.
+
+    Returns a dict with the fetches as (from_ms, station_ids) tuples, the end of
+    the fetch (now_ms) and the window and retention start.
+    """
+    now_ms = round(time.time() * 1000)
+    window_from_ms = now_ms - window_hours * 3600 * 1000
+    retain_from_ms = now_ms - max(retain_hours or 0, window_hours) * 3600 * 1000
+
+    cold_stations = []
+    warm_groups = {}
+    for station_id in station_ids:
+        hwm = get_high_water_mark(store, station_id, datatype)
+        if hwm is None or hwm < window_from_ms:
+            cold_stations.append(station_id)
+        else:
+            age_step = (max(0, now_ms - hwm) // WARM_GROUP_MIN_AGE_MS).bit_length()
+            warm_groups.setdefault(age_step, []).append(station_id)
+
+    fetches = []
+    if cold_stations:
+        fetches.append((window_from_ms, cold_stations))
+    for age_step, warm_stations in sorted(warm_groups.items()):
+        # Ninja's from is inclusive, start just after the oldest high water mark of the group
+        fetches.append((min(get_high_water_mark(store, station_id, datatype) for station_id in warm_stations) + 1, warm_stations))
+
+    return {
+        "fetches": fetches,
+        "now_ms": now_ms,
+        "window_from_ms": window_from_ms,
+        "retain_from_ms": retain_from_ms
+    }
+
+def merge_incremental_fetch(store, plan, datatype, station_ids, series):
+    """Merge the fetched rows (or StationSeries) of some stations of a plan, and return their StationSeries in the window."""
+    for station_id in station_ids:
+        merge_rows(store, station_id, datatype, series.get(station_id, []), plan["retain_from_ms"])
+    return {station_id: get_window_series(store, station_id, datatype, plan["window_from_ms"]) for station_id in station_ids}
+
+def get_charging_stations_status_incremental(host, station_type, station_ids, datatype, window_hours, store, select=DEFAULT_SELECT, retain_hours=None):
+    """Get the last window_hours of measurements of many stations, only downloading what's newer than their high water marks.
+
+    See plan_incremental_fetch for what gets fetched.
+
+    Returns a dict mapping every station code to its StationSeries in the window.
+    """
+    plan = plan_incremental_fetch(store, station_ids, datatype, window_hours, retain_hours)
+    to_date = format_query_date(plan["now_ms"])
+
+    histories = {}
+    for from_ms, stations in plan["fetches"]:
+        series = get_charging_stations_status_batch(host, station_type, format_query_date(from_ms), to_date, stations, [datatype], select)
+        histories.update(merge_incremental_fetch(store, plan, datatype, stations, series))
+
+    return {station_id: histories[station_id] for station_id in station_ids}
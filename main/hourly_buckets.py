@@ -0,0 +1,156 @@
+import json
+import math
+import os
+from bisect import bisect_right
+
+from ninja_reader import batch_station_ids, format_query_date, iter_charging_stations_status
+from timestamps import parse_mvalidtime
+from history_store import history_key, read_columns, row_time
+
+# Where the open buckets are kept between runs
+HOURLY_STATE_PATH = "state/hourly.json"
+
+HOUR_MS = 3600 * 1000
+
+# Measurements can show up in Ninja with some delay, so a station's last
+# value is only carried forward (closing hours) up to this long before now.
+# Measurements older than what's already aggregated are dropped.
+SETTLE_MS = 15 * 60 * 1000
+
+# A station's last value only counts as known time for this long after the
+# measurement. A station that stops reporting closes its hours with less and
+# less coverage, and then none at all.
+MAX_CARRY_MS = 60 * 60 * 1000
+
+def load_hourly_state(path=HOURLY_STATE_PATH):
+    """Load the open buckets of the previous runs, as {station/datatype: bucket}."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_hourly_state(state, path=HOURLY_STATE_PATH):
+    """Write the state to a temporary file first, so a crashed run never leaves a half written one."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def new_bucket(hour):
+    """An open hour. last_ms is how far it is aggregated, last_value the value carried forward, measured at sample_ms."""
+    return {"hour": hour, "known_ms": 0, "true_ms": 0, "samples": 0, "last_ms": None, "last_value": None, "sample_ms": None}
+
+def finish_bucket(station_id, bucket):
+    """The output of a bucket: (station, hour start ms, availability percentage, sample count, coverage)."""
+    value = bucket["true_ms"] / bucket["known_ms"] * 100 if bucket["known_ms"] else None
+    return (station_id, bucket["hour"], value, bucket["samples"], bucket["known_ms"] / HOUR_MS)
+
+def advance(bucket, station_id, to_ms, predicate, closed):
+    """Carry the last value of a station forward to to_ms (at most MAX_CARRY_MS past its measurement), closing every hour that ends on the way.
+
+    Hours without any measurement or known time aren't closed into closed.
+    """
+    sample_ms = bucket.get("sample_ms")
+    if sample_ms is None:
+        # A bucket from before sample_ms was kept
+        sample_ms = bucket["last_ms"]
+    while bucket["last_ms"] is not None and bucket["last_ms"] < to_ms:
+        hour_end = bucket["hour"] + HOUR_MS
+        end = min(to_ms, hour_end)
+        known_end = min(end, sample_ms + MAX_CARRY_MS)
+        if bucket["last_value"] is not None and known_end > bucket["last_ms"]:
+            bucket["known_ms"] += known_end - bucket["last_ms"]
+            if predicate(bucket["last_value"]):
+                bucket["true_ms"] += known_end - bucket["last_ms"]
+        bucket["last_ms"] = end
+        if end == hour_end:
+            if bucket["samples"] or bucket["known_ms"]:
+                closed.append(finish_bucket(station_id, bucket))
+            last_value = bucket["last_value"]
+            bucket.update(new_bucket(hour_end))
+            bucket["last_ms"] = hour_end
+            bucket["last_value"] = last_value
+            bucket["sample_ms"] = sample_ms
+
+def add_measurement(state, station_id, datatype, time_ms, value, predicate, closed):
+    """Feed one measurement to the open bucket of its station. Measurements at or before the last one are dropped."""
+    key = history_key(station_id, datatype)
+    bucket = state.get(key)
+    if bucket is None:
+        bucket = state[key] = new_bucket(time_ms - time_ms % HOUR_MS)
+    elif bucket["last_ms"] is not None and time_ms <= bucket["last_ms"]:
+        return
+    if bucket["last_ms"] is None:
+        bucket["last_ms"] = time_ms
+    advance(bucket, station_id, time_ms, predicate, closed)
+    bucket["samples"] += 1
+    bucket["last_value"] = value
+    bucket["sample_ms"] = time_ms
+
+def settle(state, datatype, now_ms, predicate, closed, station_ids=None):
+    """Carry every station of the data type forward to now_ms - SETTLE_MS, closing the hours that are over.
+
+    With station_ids, the buckets of the other stations of the data type
+    (no longer active ones) are dropped instead.
+    """
+    suffix = f"/{datatype}"
+    active = None if station_ids is None else set(station_ids)
+    for key in [key for key in state if key.endswith(suffix)]:
+        station_id = key[:-len(suffix)]
+        if active is not None and station_id not in active:
+            del state[key]
+        else:
+            advance(state[key], station_id, now_ms - SETTLE_MS, predicate, closed)
+
+def feed_measurements(state, measurements, datatype, predicate, closed):
+    for station_id, time_ms, value in measurements:
+        add_measurement(state, station_id, datatype, time_ms, value, predicate, closed)
+
+def feed_rows(state, rows, datatype, predicate, closed):
+    feed_measurements(state, ((row['scode'], parse_mvalidtime(row['mvalidtime']), row.get('mvalue')) for row in rows), datatype, predicate, closed)
+
+def aggregate_hourly(state, measurements, datatype, now_ms, predicate=lambda value: value > 0, station_ids=None):
+    """Aggregate (station, time ms, value) measurements (each station's oldest first) into hour aligned buckets in one pass.
+
+    Returns the buckets that got closed, see finish_bucket. The value of a
+    bucket is the time weighted share of its hour in which predicate holds,
+    coverage the share of the hour with a known value. The hour a station is
+    in stays open in state, and is continued by the next call without
+    looking at the closed hours again. With station_ids, the state of other
+    stations of the data type is dropped, see settle.
+    """
+    closed = []
+    feed_measurements(state, measurements, datatype, predicate, closed)
+    settle(state, datatype, now_ms, predicate, closed, station_ids)
+    return closed
+
+def open_buckets(state, datatype):
+    """The hours still open, as finish_bucket tuples (so far)."""
+    suffix = f"/{datatype}"
+    return [finish_bucket(key[:-len(suffix)], bucket) for key, bucket in state.items() if key.endswith(suffix)]
+
+def new_store_measurements(state, store, station_ids, datatype):
+    """The measurements of the history store (see history_store) the state hasn't aggregated yet, as (station, time ms, value)."""
+    for station_id in station_ids:
+        key = history_key(station_id, datatype)
+        last_ms = state.get(key, {}).get("last_ms")
+        series = read_columns(store, key)
+        # The store keeps measurements oldest first
+        start = 0 if last_ms is None else bisect_right(series.times, last_ms)
+        for time_ms, value in zip(series.times[start:], series.values[start:]):
+            # Unknown values are NaN in the store and None in the buckets
+            yield station_id, time_ms, None if math.isnan(value) else value
+
+def backfill_hourly(host, station_type, station_ids, datatype, from_ms, to_ms, state, predicate=lambda value: value > 0):
+    """Aggregate [from_ms, to_ms) of the stations from Ninja in one pass, streaming in time slices. Returns the closed buckets."""
+    closed = []
+    from_date = format_query_date(from_ms)
+    to_date = format_query_date(to_ms)
+    for batch in batch_station_ids(host, station_type, from_date, to_date, station_ids, datatypes=[datatype]):
+        for rows in iter_charging_stations_status(host, station_type, from_date, to_date, batch, [datatype]):
+            feed_rows(state, sorted(rows, key=row_time), datatype, predicate, closed)
+    settle(state, datatype, to_ms + SETTLE_MS, predicate, closed)
+    return closed
@@ -0,0 +1,116 @@
+import json
+from array import array
+
+from json_stream import JsonStream, iter_json_array
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+class Measurement:
+    """One Ninja measurement row, with the fields the metrics use.
+
+    Supports row['mvalue'] and row.get('mvalue') like the decoded dicts, so
+    the metric functions work on both.
+    """
+    __slots__ = ("scode", "tname", "mvalidtime", "mvalue")
+
+    def __init__(self, scode=None, tname=None, mvalidtime=None, mvalue=None):
+        self.scode = scode
+        self.tname = tname
+        self.mvalidtime = mvalidtime
+        self.mvalue = mvalue
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __repr__(self):
+        return f"Measurement({self.scode!r}, {self.tname!r}, {self.mvalidtime!r}, {self.mvalue!r})"
+
+def stdlib_dumps(value):
+    return json.dumps(value, separators=(",", ":"))
+
+# name: (loads, dumps). loads takes bytes, dumps may return str or bytes,
+# both are accepted as request body.
+BACKENDS = {"stdlib": (json.loads, stdlib_dumps)}
+if ujson is not None:
+    BACKENDS["ujson"] = (ujson.loads, ujson.dumps)
+if orjson is not None:
+    BACKENDS["orjson"] = (orjson.loads, orjson.dumps)
+
+# Fastest available first
+BACKEND_PREFERENCE = ["orjson", "ujson", "stdlib"]
+
+def get_backend(name=None):
+    """The (name, loads, dumps) of a backend, the fastest installed one if name is None."""
+    if name is None:
+        name = next(name for name in BACKEND_PREFERENCE if name in BACKENDS)
+    loads, dumps = BACKENDS[name]
+    return name, loads, dumps
+
+backend_name, loads, dumps = get_backend()
+
+def build_rows(elements, fields, row_type):
+    """Turn the decoded elements of a `data` array into rows of row_type, one element at a time.
+
+    elements may be a generator (see iter_json_array): every element is
+    converted as soon as it is decoded, there is no list of dicts in between.
+    "record" gives Measurement records, "columns" one column per field
+    (mvalue as a float64 array, NaN for null, the others as lists), "dict"
+    the elements cut down to fields.
+    """
+    if row_type == "record":
+        # Fields not asked for are looked up as "", which no element has
+        slots = [slot if fields is None or slot in fields else "" for slot in Measurement.__slots__]
+        return [Measurement(*map(element.get, slots)) for element in elements]
+    if row_type == "columns":
+        fields = list(fields or Measurement.__slots__)
+        columns = {field: array('d') if field == "mvalue" else [] for field in fields}
+        nan = float("nan")
+        for element in elements:
+            for field in fields:
+                value = element.get(field)
+                if field == "mvalue" and value is None:
+                    value = nan
+                columns[field].append(value)
+        return columns
+    if fields is not None:
+        return [{field: element[field] for field in fields if field in element} for element in elements]
+    return list(elements)
+
+def decode_rows(response, fields=None, row_type="dict", backend=None):
+    """Decode the `data` array of a streamed Ninja response.
+
+    With the stdlib backend the body is decoded incrementally while it
+    downloads (see json_stream), and every row is built as soon as its
+    element is decoded. The accelerated backends give up streaming: they
+    read and decode the whole (page sized) body at once, which is still
+    faster, and build the rows from the decoded elements after that. With
+    fields, rows only have those fields.
+
+    row_type is "dict", "record" (Measurement) or "columns" (see build_rows).
+    The response is closed once its body is decoded. Returns the rows and the
+    size of the body in bytes.
+    """
+    name, backend_loads, backend_dumps = get_backend(backend or backend_name)
+    try:
+        if name == "stdlib":
+            stream = JsonStream(response)
+            rows = build_rows(iter_json_array(response, stream=stream), fields, row_type)
+            size = stream.bytes_read
+        else:
+            body = response.content
+            rows = build_rows(backend_loads(body)["data"], fields, row_type)
+            size = len(body)
+    finally:
+        response.close()
+    return rows, size
@@ -0,0 +1,99 @@
+import codecs
+import json
+
+# Bytes read from the connection at a time
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = " \t\n\r"
+
+class JsonStream:
+    """Incremental reader over a streamed (stream=True) response body.
+
+    Values are decoded one at a time with the stdlib decoder, only the part of
+    the body that hasn't been decoded yet is kept in memory.
+    """
+
+    def __init__(self, response, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunks = response.iter_content(chunk_size)
+        self.text_decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+        self.decoder = json.JSONDecoder()
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+        self.bytes_read = 0
+
+    def fill(self):
+        """Read the next chunk into the buffer. Returns False at the end of the body."""
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            self.buffer += self.text_decoder.decode(b"", final=True)
+            return False
+        self.bytes_read += len(chunk)
+        # Drop what's already decoded before growing the buffer
+        if self.position > self.chunk_size:
+            self.buffer = self.buffer[self.position:]
+            self.position = 0
+        self.buffer += self.text_decoder.decode(chunk)
+        return True
+
+    def peek(self):
+        """Next non whitespace character, without consuming it. Empty at the end of the body."""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer) or not self.fill():
+                return self.buffer[self.position:self.position + 1]
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} at offset {self.position}, found {found!r}")
+        self.position += 1
+
+    def decode_value(self):
+        """Decode the next JSON value, reading more of the body until it is complete."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+def iter_json_array(response, key="data", fields=None, chunk_size=DEFAULT_CHUNK_SIZE, stream=None):
+    """Yield the elements of the top level `key` array of a streamed JSON response while it downloads.
+
+    With fields, every element (an object) is cut down to those fields right
+    after it is decoded, so the rest of it is never kept. Pass a JsonStream
+    as stream to read the number of bytes read afterwards.
+    """
+    stream = stream or JsonStream(response, chunk_size)
+    stream.expect("{")
+    while stream.peek() != "}":
+        name = stream.decode_value()
+        stream.expect(":")
+        if name != key:
+            stream.decode_value()
+        else:
+            stream.expect("[")
+            if stream.peek() == "]":
+                return
+            while True:
+                element = stream.decode_value()
+                if fields is not None:
+                    element = {field: element[field] for field in fields if field in element}
+                yield element
+                if stream.peek() == "]":
+                    return
+                stream.expect(",")
+        if stream.peek() == ",":
+            stream.position += 1
@@ -0,0 +1,167 @@
+import math
+from array import array
+from bisect import bisect_left
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def flat_columns(batch, datatype):
+    """The measurements of a data type of every station of a SeriesBatch as flat NumPy columns.
+
+    Returns station codes (of batch.stations), times and values, sorted by
+    station and time. Needs NumPy.
+    """
+    datatype_code = batch.datatypes.lookup(datatype)
+    keys = sorted(key for key, series in batch.series.items() if key[1] == datatype_code and len(series))
+    if not keys:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    columns = [batch.series[key].as_numpy() for key in keys]
+    stations = np.repeat(np.array([key[0] for key in keys], dtype=np.int64), [len(times) for times, values in columns])
+    return stations, np.concatenate([times for times, values in columns]), np.concatenate([values for times, values in columns])
+
+def window_columns(batch, datatype, from_ms, to_ms=None, flat=None, carry_in=False):
+    """The measurements of a data type in [from_ms, to_ms) of every station of a SeriesBatch, grouped by station.
+
+    With carry_in, every station also keeps its last measurement before
+    from_ms, like StationSeries.slice. Returns the station codes (of
+    batch.stations) of the groups, the start of every group, the times and
+    the values. With NumPy the window is cut from flat (the flat_columns of
+    the batch, computed if None) with one mask, and times and values are
+    int64 and float64 arrays. Otherwise they are an array('q') and an array('d').
+    """
+    if np is not None:
+        stations, times, values = flat if flat is not None else flat_columns(batch, datatype)
+        mask = times >= from_ms
+        if carry_in and len(times):
+            # The last measurement of a station before from_ms is followed by
+            # one in the window, by another station or by nothing
+            followed = np.append(mask[1:] | (stations[1:] != stations[:-1]), True)
+            mask |= (times < from_ms) & followed
+        if to_ms is not None:
+            mask &= times < to_ms
+        stations = stations[mask]
+        times = times[mask]
+        values = values[mask]
+        if len(stations) == 0:
+            return [], np.zeros(0, dtype=np.int64), times, values
+        starts = np.flatnonzero(np.concatenate(([True], stations[1:] != stations[:-1])))
+        return stations[starts].tolist(), starts, times, values
+
+    datatype_code = batch.datatypes.lookup(datatype)
+    stations = []
+    starts = []
+    times = array('q')
+    values = array('d')
+    for (station, series_datatype), series in sorted(batch.series.items()):
+        if series_datatype != datatype_code:
+            continue
+        start = bisect_left(series.times, from_ms)
+        if carry_in and start > 0:
+            start -= 1
+        end = len(series.times) if to_ms is None else bisect_left(series.times, to_ms)
+        if start >= end:
+            continue
+        stations.append(station)
+        starts.append(len(values))
+        times.extend(series.times[start:end])
+        values.extend(series.values[start:end])
+    return stations, starts, times, values
+
+def positive_counts(starts, values):
+    """Number of values > 0 of every group."""
+    if np is not None:
+        if len(values) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.add.reduceat((values > 0).astype(np.int64), starts)
+    ends = list(starts[1:]) + [len(values)]
+    return [sum(1 for value in values[start:end] if value > 0) for start, end in zip(starts, ends)]
+
+def group_sizes(starts, values):
+    if np is not None:
+        return np.diff(np.append(starts, len(values)))
+    ends = list(starts[1:]) + [len(values)]
+    return [end - start for start, end in zip(starts, ends)]
+
+def availability_percentage(starts, times, values, from_ms, to_ms):
+    """Per group: percentage of the values > 0, like compute_availability_percentage."""
+    positive = positive_counts(starts, values)
+    sizes = group_sizes(starts, values)
+    if np is not None:
+        return ((positive / sizes) * 100).tolist()
+    return [(available / total) * 100 for available, total in zip(positive, sizes)]
+
+def used_charging(starts, times, values, from_ms, to_ms):
+    """Per group: number of values > 0, like compute_used_charging."""
+    positive = positive_counts(starts, values)
+    return positive.tolist() if np is not None else positive
+
+def time_weighted_availability(starts, times, values, from_ms, to_ms):
+    """Per group: percentage of the known time of [from_ms, to_ms) with a value > 0, like compute_time_weighted_availability.
+
+    Every value holds until the next measurement of its station (or to_ms),
+    clipped to the window. The groups need their carried in measurement, see
+    window_columns(carry_in=True).
+    """
+    if np is not None:
+        if len(values) == 0:
+            return []
+        ends = np.append(starts[1:], len(values))
+        next_times = np.append(times[1:], to_ms)
+        next_times[ends - 1] = to_ms
+        durations = np.maximum(np.minimum(next_times, to_ms) - np.maximum(times, from_ms), 0)
+        known_ms = np.add.reduceat(np.where(np.isnan(values), 0, durations), starts)
+        true_ms = np.add.reduceat(np.where(values > 0, durations, 0), starts)
+        percentages = (true_ms / np.maximum(known_ms, 1)) * 100
+        return np.where(known_ms > 0, percentages, 0).tolist()
+
+    ends = list(starts[1:]) + [len(values)]
+    percentages = []
+    for start, end in zip(starts, ends):
+        known_ms = 0
+        true_ms = 0
+        for i in range(start, end):
+            duration = min(times[i + 1] if i + 1 < end else to_ms, to_ms) - max(times[i], from_ms)
+            if duration <= 0 or math.isnan(values[i]):
+                continue
+            known_ms += duration
+            if values[i] > 0:
+                true_ms += duration
+        percentages.append((true_ms / known_ms) * 100 if known_ms else 0)
+    return percentages
+
+# Vectorized kernels by name, see declare_metric(kernel=...). A kernel gets the
+# group starts, times and values of all stations and the window
+# [from_ms, to_ms), and returns one value per group. Stations without
+# measurements in the window get EMPTY_VALUE.
+KERNELS = {
+    "availability_percentage": availability_percentage,
+    "used_charging": used_charging,
+    "time_weighted_availability": time_weighted_availability
+}
+EMPTY_VALUE = 0
+
+def compute_batch_metrics(metrics, batch, now_ms, station_ids=None):
+    """Run every metric over all stations of a SeriesBatch at once. Returns {station: {metric name: value}}.
+
+    Every metric needs a kernel. Gives the same numbers as running the
+    metric's compute function per station. With station_ids, only those
+    stations are in the results.
+    """
+    results = {}
+    # With NumPy, every data type is flattened once and shared by its metrics
+    flat = {}
+    for metric in metrics:
+        datatype = metric["datatype"]
+        if np is not None and datatype not in flat:
+            flat[datatype] = flat_columns(batch, datatype)
+        from_ms = now_ms - metric["window_hours"] * 3600 * 1000
+        stations, starts, times, values = window_columns(batch, datatype, from_ms, flat=flat.get(datatype), carry_in=metric["carry_in"])
+        computed = dict(zip(stations, KERNELS[metric["kernel"]](starts, times, values, from_ms, now_ms)))
+        for station_id in metric["station_ids"] if station_ids is None else station_ids:
+            if station_id not in metric["station_set"]:
+                continue
+            station = batch.stations.lookup(station_id)
+            results.setdefault(station_id, {})[metric["name"]] = computed.get(station, EMPTY_VALUE)
+    return results
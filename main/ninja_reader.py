@@ -0,0 +1,239 @@
+import json
+import os
+import requests
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from odh_client import read_client
+from json_codec import decode_rows
+
+# Number of station codes per history request, and a conservative upper bound
+# for the full request URL (proxies and Ninja start rejecting around 8KB)
+DEFAULT_BATCH_SIZE = 100
+MAX_URL_LENGTH = 4000
+
+# Only the fields the metrics read. The flat,node representation otherwise
+# repeats the full station and data type metadata on every row.
+DEFAULT_SELECT = ["scode", "mvalidtime", "mvalue"]
+
+# Rows per page of a paged request, and the time span of one slice of a
+# history query. Slicing by mvalidtime keeps the offsets within a slice small,
+# Ninja gets slow on deep offsets.
+DEFAULT_PAGE_SIZE = 10000
+DEFAULT_SLICE_MS = 6 * 3600 * 1000
+
+# A slice that runs into Ninja's response size or query time limit is split
+# in halves, down to this span
+MIN_SLICE_MS = 5 * 60 * 1000
+
+# The projection ratio is measured once (two extra queries) and kept here
+PROJECTION_RATIO_PATH = "state/projection_ratio.json"
+
+# Downloaded volume of the current run, see record_response / print_read_stats
+read_stats = {
+    "requests": 0,
+    "rows": 0,
+    "bytes": 0
+}
+
+def format_mvalidtime(epoch_ms):
+    """Format epoch milliseconds like a Ninja mvalidtime, in UTC."""
+    return datetime.fromtimestamp(epoch_ms / 1000, timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3] + "+0000"
+
+def format_query_date(epoch_ms):
+    """Format epoch milliseconds as a from/to date of a Ninja query, in UTC."""
+    return datetime.fromtimestamp(epoch_ms / 1000, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+
+def parse_query_date(query_date):
+    """Convert a from/to date of a Ninja query (UTC, with or without milliseconds) to epoch milliseconds."""
+    date_format = "%Y-%m-%dT%H:%M:%S.%f" if "." in query_date else "%Y-%m-%dT%H:%M:%S"
+    return round(datetime.strptime(query_date, date_format).replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+def encode_station_code(station_id):
+    """Quote a station code for a `scode.in.(...)` list."""
+    return f"%22{quote(station_id, safe='')}%22"
+
+def build_scode_filter(station_ids):
+    """Build the URL encoded `scode.in.(...)` filter for a list of station codes."""
+    codes = ",".join(encode_station_code(station_id) for station_id in station_ids)
+    return f"scode.in.%28{codes}%29"
+
+def build_datatype_path(datatypes):
+    """Path segment for a list of data types, `*` (all data types) if None."""
+    if not datatypes:
+        return "%2A"
+    return quote(",".join(datatypes), safe='')
+
+def build_select(datatypes, select):
+    """Comma separated select list. tname is added when rows of several data types can come back."""
+    fields = list(select)
+    if (not datatypes or len(datatypes) > 1) and "tname" not in fields:
+        fields.append("tname")
+    return ",".join(fields)
+
+def build_history_url(host, station_type, from_date, to_date, station_ids, datatypes=None, select=DEFAULT_SELECT, limit=-1, offset=0):
+    """Build the Ninja history URL for one or more stations.
+
+    datatypes=None queries every data type of the stations, select=None
+    returns every field of every row.
+    """
+    url = f"{host}/{station_type}/{build_datatype_path(datatypes)}/{from_date}/{to_date}?limit={limit}&offset={offset}&shownull=false&distinct=true&where=sactive.eq.true,{build_scode_filter(station_ids)}&timezone=UTC"
+    if select:
+        url += f"&select={build_select(datatypes, select)}"
+    return url
+
+def batch_station_ids(host, station_type, from_date, to_date, station_ids, batch_size=DEFAULT_BATCH_SIZE, max_url_length=MAX_URL_LENGTH, datatypes=None, select=DEFAULT_SELECT):
+    """Split station codes into batches that respect both batch_size and max_url_length."""
+    base_length = len(build_history_url(host, station_type, from_date, to_date, [], datatypes, select))
+    batches = []
+    current = []
+    current_length = base_length
+
+    for station_id in station_ids:
+        # one comma separator for every code after the first
+        code_length = len(encode_station_code(station_id)) + (1 if current else 0)
+        if current and (len(current) >= batch_size or current_length + code_length > max_url_length):
+            batches.append(current)
+            current = []
+            current_length = base_length
+            code_length -= 1
+        current.append(station_id)
+        current_length += code_length
+
+    if current:
+        batches.append(current)
+    return batches
+
+def record_response(response, rows, size=None):
+    """Add a response to the read statistics of the current run. Pass size for streamed responses."""
+    read_stats["requests"] += 1
+    read_stats["rows"] += rows
+    read_stats["bytes"] += len(response.content) if size is None else size
+
+def reset_read_stats():
+    for key in read_stats:
+        read_stats[key] = 0
+
+def measure_projection_ratio(host, station_type, from_date, to_date, station_id, datatypes, select=DEFAULT_SELECT):
+    """Compare the size of the full and the projected response for one sample station.
+
+    Returns how many bytes the unprojected query (all data types, all fields)
+    downloads for every byte of the projected one, or None if it can't be measured.
+    """
+    headers = {
+        "Content-Type": "application/json"
+    }
+    full = read_client.get(build_history_url(host, station_type, from_date, to_date, [station_id], None, None), headers=headers)
+    projected = read_client.get(build_history_url(host, station_type, from_date, to_date, [station_id], datatypes, select), headers=headers)
+    if full.status_code != 200 or projected.status_code != 200 or len(projected.content) == 0:
+        return None
+    return len(full.content) / len(projected.content)
+
+def get_projection_ratio(host, station_type, from_date, to_date, station_ids, datatypes, select=DEFAULT_SELECT, path=PROJECTION_RATIO_PATH):
+    """The projection ratio (see measure_projection_ratio) of the station type and data types.
+
+    Measured on the first of station_ids the first time, later runs reuse the
+    stored ratio. None if there are no stations or it can't be measured.
+    """
+    key = f"{station_type}/{','.join(datatypes)}"
+    ratios = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            ratios = json.load(f)
+    if key in ratios or not station_ids:
+        return ratios.get(key)
+    ratio = measure_projection_ratio(host, station_type, from_date, to_date, station_ids[0], datatypes, select)
+    if ratio is not None:
+        ratios[key] = ratio
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(ratios, f)
+    return ratio
+
+def print_read_stats(projection_ratio=None):
+    """Print the downloaded volume of the run, and the estimated savings of the projection."""
+    print(f"Ninja requests: {read_stats['requests']}, rows: {read_stats['rows']}, bytes: {read_stats['bytes']}")
+    if projection_ratio is not None:
+        saved = round(read_stats['bytes'] * (projection_ratio - 1))
+        print(f"Bytes saved by data type and field projection: ~{saved} ({projection_ratio:.1f}x smaller)")
+
+def iter_pages(url_for_page, page_size=DEFAULT_PAGE_SIZE, fields=None):
+    """Yield the `data` array of a Ninja query page by page, using limit/offset.
+
+    url_for_page(limit, offset) builds the URL of one page. Only one page is
+    held in memory at a time, and it is decoded while it downloads, keeping
+    only the given fields of every row. Raises requests.HTTPError on a failed page.
+    """
+    headers = {
+        "Content-Type": "application/json"
+    }
+    offset = 0
+    while True:
+        response = read_client.get(url_for_page(page_size, offset), headers=headers, stream=True)
+        response.raise_for_status()
+        data, size = decode_rows(response, fields)
+        record_response(response, len(data), size)
+        if data:
+            yield data
+        if len(data) < page_size:
+            return
+        offset += page_size
+
+def iter_charging_stations_status(host, station_type, from_date, to_date, station_ids, datatypes=None, select=DEFAULT_SELECT, page_size=DEFAULT_PAGE_SIZE, slice_ms=DEFAULT_SLICE_MS):
+    """Yield the history of the stations in chunks of rows, with bounded memory.
+
+    The window is walked in slices of slice_ms on mvalidtime, each slice is
+    paged with page_size rows per request. A slice that fails before any of
+    its rows came back is split in halves and retried, down to MIN_SLICE_MS.
+    """
+    from_ms = parse_query_date(from_date)
+    to_ms = parse_query_date(to_date)
+    fields = build_select(datatypes, select).split(",") if select else None
+    # Oldest slice last, it's popped first
+    slices = [(slice_from, min(slice_from + slice_ms, to_ms)) for slice_from in range(from_ms, to_ms, slice_ms)][::-1]
+    while slices:
+        slice_from, slice_to = slices.pop()
+        slice_from_date = format_query_date(slice_from)
+        slice_to_date = format_query_date(slice_to)
+        returned_rows = False
+        try:
+            for data in iter_pages(lambda limit, offset: build_history_url(host, station_type, slice_from_date, slice_to_date, station_ids, datatypes, select, limit, offset), page_size, fields):
+                returned_rows = True
+                yield data
+        except requests.RequestException as e:
+            # Once rows of the slice are out, retrying its halves would return them twice
+            if returned_rows or slice_to - slice_from <= MIN_SLICE_MS:
+                raise
+            print(f"Slice {slice_from_date} - {slice_to_date} failed, splitting it: {e}")
+            middle = (slice_from + slice_to) // 2
+            slices.extend([(middle, slice_to), (slice_from, middle)])
+
+def split_by_station(rows, series):
+    """Append the rows of a Ninja `data` array to the per station series, keyed by scode."""
+    for row in rows:
+        series.setdefault(row.get('scode'), []).append(row)
+    return series
+
+def get_charging_stations_status_batch(host, station_type, from_date, to_date, station_ids, datatypes=None, select=DEFAULT_SELECT, batch_size=DEFAULT_BATCH_SIZE, max_url_length=MAX_URL_LENGTH, failed=None):
+    """Get the history of many stations, with one request per batch of station codes.
+
+    Returns a dict mapping every requested station code to its list of rows.
+    Stations of a failed batch keep an empty list, and are added to the
+    failed list if one is given.
+    """
+    series = {station_id: [] for station_id in station_ids}
+
+    for batch in batch_station_ids(host, station_type, from_date, to_date, station_ids, batch_size, max_url_length, datatypes, select):
+        try:
+            for rows in iter_charging_stations_status(host, station_type, from_date, to_date, batch, datatypes, select):
+                split_by_station(rows, series)
+        except requests.RequestException as e:
+            print(f"Error fetching data for {len(batch)} stations ({batch[0]} - {batch[-1]}): {e}")
+            for station_id in batch:
+                series[station_id] = []
+            if failed is not None:
+                failed.extend(batch)
+
+    return series
@@ -0,0 +1,260 @@
+import random
+import requests
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+
+from rate_limiter import MAX_LIMIT, get_controller, percentile
+
+# Connections kept open per host. Should be at least the number of requests
+# we run in parallel against one host, otherwise connections get thrown away.
+DEFAULT_POOL_SIZE = 16
+
+# (connect, read) timeouts in seconds. Ninja cancels queries after 30 seconds
+# (NINJA_QUERY_TIMEOUT_SEC), so the read timeout leaves room for the transfer.
+# Pass timeout= to a single request to override it.
+DEFAULT_TIMEOUT = (5, 60)
+
+# Retries of a failed request (connection error, timeout or one of
+# RETRY_STATUSES). Only idempotent requests are retried: a BDP push that
+# timed out may still have been stored.
+DEFAULT_RETRIES = 3
+RETRY_METHODS = ["GET"]
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# Exponential backoff: attempt n waits a random time up to
+# BACKOFF_BASE_SEC * 2^n (at most BACKOFF_MAX_SEC). A Retry-After header is
+# honoured even if it asks for longer, up to RETRY_AFTER_MAX_SEC in case a
+# server sends something absurd.
+BACKOFF_BASE_SEC = 0.5
+BACKOFF_MAX_SEC = 30
+RETRY_AFTER_MAX_SEC = 600
+
+# Hedging: a GET that didn't answer within the p95 latency of the client gets
+# a duplicate, and the first response wins. Only once there are enough
+# latencies for a p95.
+HEDGE_READS = False
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WORKERS = 16
+
+# Requests, retries and hedges of the current run, see print_request_stats
+request_stats = {
+    "requests": 0,
+    "retries": 0,
+    "hedges": 0,
+    "hedge_wins": 0
+}
+request_stats_lock = threading.Lock()
+
+hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+
+def count_request(key):
+    with request_stats_lock:
+        request_stats[key] += 1
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (seconds or an HTTP date), None if missing or invalid."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, retry_after=None):
+    """Seconds to wait before retry number attempt (from 0), with full jitter."""
+    delay = random.uniform(0, min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * 2 ** attempt))
+    retry_after = parse_retry_after(retry_after)
+    if retry_after is not None:
+        delay = max(delay, min(RETRY_AFTER_MAX_SEC, retry_after))
+    return delay
+
+def release_after_body(response, release):
+    """Call release once the body of a streamed response is closed.
+
+    decode_rows closes the response when it's done with the body, and a
+    response that is never closed still releases when it's garbage collected.
+    The close wrapper only holds a weak reference, so it doesn't keep the
+    response alive.
+    """
+    finalizer = weakref.finalize(response, release)
+    response_ref = weakref.ref(response)
+
+    def close():
+        closed = response_ref()
+        try:
+            if closed is not None:
+                type(closed).close(closed)
+        finally:
+            finalizer()
+
+    response.close = close
+
+def close_response(future):
+    """Release the connection of a hedged request that lost."""
+    if future.exception() is None:
+        future.result().close()
+
+class OdhClient:
+    """HTTP client for one Open Data Hub endpoint.
+
+    Owns a requests.Session, so TCP and TLS connections are kept alive and
+    reused across calls, with a connection pool of pool_size per host,
+    default headers and a default timeout for every request. With
+    rate_limited, the requests of every host go through its AimdController.
+    GET requests are retried with backoff, and hedged if hedge is set.
+    """
+
+    def __init__(self, headers=None, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, rate_limited=False, retries=DEFAULT_RETRIES, hedge=False):
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        self.timeout = timeout
+        self.rate_limited = rate_limited
+        self.retries = retries
+        self.hedge = hedge
+        self.latencies = deque(maxlen=200)
+        self.latencies_lock = threading.Lock()
+        self.set_pool_size(pool_size)
+
+    def set_pool_size(self, pool_size):
+        """Size the connection pool to the number of parallel requests.
+
+        Replaces (and closes) the pools of the session, so only call it before
+        the client is used from several threads, e.g. at startup.
+        """
+        if self.rate_limited:
+            # Every fetch thread and event loop goes through the controller,
+            # which lets up to MAX_LIMIT requests per host run at once
+            pool_size = max(pool_size, MAX_LIMIT)
+        if getattr(self, "pool_size", None) == pool_size:
+            return
+        self.pool_size = pool_size
+        old_adapters = set(self.session.adapters.values())
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        for old_adapter in old_adapters:
+            old_adapter.close()
+
+    def send(self, method, url, **kwargs):
+        """Send a single request, through the rate limiter of its host if the client is rate limited.
+
+        The rate limiter slot of a streamed response is held until its body
+        is read and the response closed, so the controller sees the whole
+        query time and not just the time to the headers.
+        """
+        controller = get_controller(url) if self.rate_limited else None
+        if controller is not None:
+            controller.acquire()
+        started = time.monotonic()
+        status = None
+        released = False
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status = response.status_code
+            # Until the headers are in, a streamed body is read after
+            with self.latencies_lock:
+                self.latencies.append(time.monotonic() - started)
+            if controller is not None and kwargs.get("stream"):
+                release_after_body(response, lambda: controller.release(time.monotonic() - started, status))
+                released = True
+            return response
+        finally:
+            if controller is not None and not released:
+                controller.release(time.monotonic() - started, status)
+
+    def hedge_delay(self):
+        """Seconds after which a request gets hedged, None while there are too few latencies."""
+        with self.latencies_lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            return percentile(self.latencies, 0.95)
+
+    def send_hedged(self, method, url, **kwargs):
+        """Send a request, and a duplicate if it takes longer than the p95 latency. Returns the first response."""
+        delay = self.hedge_delay()
+        if delay is None:
+            return self.send(method, url, **kwargs)
+        first = hedge_executor.submit(self.send, method, url, **kwargs)
+        try:
+            return first.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+
+        count_request("hedges")
+        second = hedge_executor.submit(self.send, method, url, **kwargs)
+        done, pending = wait([first, second], return_when=FIRST_COMPLETED)
+        winner = done.pop()
+        if winner.exception() is not None and pending:
+            # The faster one failed, the other one may still make it
+            winner = pending.pop()
+        for future in (first, second):
+            if future is not winner:
+                future.add_done_callback(close_response)
+        if winner is second:
+            count_request("hedge_wins")
+        return winner.result()
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        retries = self.retries if method in RETRY_METHODS else 0
+        hedge = self.hedge and method == "GET"
+        for attempt in range(retries + 1):
+            count_request("requests")
+            try:
+                response = self.send_hedged(method, url, **kwargs) if hedge else self.send(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == retries:
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"Retrying {method} {url} in {delay:.1f}s: {e}")
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == retries:
+                    return response
+                delay = backoff_delay(attempt, response.headers.get("Retry-After"))
+                print(f"Retrying {method} {url} in {delay:.1f}s: status {response.status_code}")
+                response.close()
+            count_request("retries")
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+# One client per endpoint: Keycloak, the Ninja read API and the BDP write API.
+# Only the public Ninja API rate limits us.
+auth_client = OdhClient()
+read_client = OdhClient(headers={"Accept": "application/json"}, rate_limited=True, hedge=HEDGE_READS)
+write_client = OdhClient(headers={"Content-Type": "application/json"})
+
+def set_pool_size(pool_size):
+    """Size the connection pools of all clients to the concurrency of the run. Call it once at startup.
+
+    The pool of the rate limited read client is never smaller than what its
+    controllers let run at once, see OdhClient.set_pool_size.
+    """
+    for client in (auth_client, read_client, write_client):
+        client.set_pool_size(pool_size)
+
+def reset_request_stats():
+    for key in request_stats:
+        request_stats[key] = 0
+
+def print_request_stats():
+    """Retry and hedge rates of the run."""
+    requests_sent = request_stats["requests"] or 1
+    print(f"Requests: {request_stats['requests']}, retries: {request_stats['retries']} ({request_stats['retries'] / requests_sent:.1%}), "
+          f"hedges: {request_stats['hedges']} ({request_stats['hedges'] / requests_sent:.1%}), won by the hedge: {request_stats['hedge_wins']}")
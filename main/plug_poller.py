@@ -0,0 +1,143 @@
+import requests
+import time
+
+from ninja_reader import iter_pages
+from timestamps import parse_mvalidtime
+
+PLUG_STATION_TYPE = "EChargingPlug"
+PLUG_STATUS_DATATYPE = "echarging-plug-status"
+
+# echarging-plug-status is 1 while the plug is free and 0 while it is in use
+PLUG_STATUS_FREE = 1
+
+FREE = "free"
+OCCUPIED = "occupied"
+
+POLL_INTERVAL_SEC = 60
+
+# Hourly buckets older than this are dropped from the metrics
+RETAIN_HOURS = 24
+
+HOUR_MS = 3600 * 1000
+
+def plug_state(mvalue):
+    return FREE if mvalue == PLUG_STATUS_FREE else OCCUPIED
+
+def fetch_plug_statuses(host):
+    """The latest status of every active plug, as {plug code: (epoch ms, state, station code)}. One request per page."""
+    url = f"{host}/{PLUG_STATION_TYPE}/{PLUG_STATUS_DATATYPE}/latest?select=scode,pcode,mvalidtime,mvalue&limit={{limit}}&offset={{offset}}&where=sactive.eq.true&shownull=false"
+    statuses = {}
+    for data in iter_pages(lambda limit, offset: url.format(limit=limit, offset=offset), fields=['scode', 'pcode', 'mvalidtime', 'mvalue']):
+        for entry in data:
+            statuses[entry['scode']] = (parse_mvalidtime(entry['mvalidtime']), plug_state(entry.get('mvalue')), entry.get('pcode', entry['scode']))
+    return statuses
+
+def diff_statuses(plugs, statuses):
+    """Update the known plugs with a snapshot and return the transitions as events.
+
+    plugs maps a plug code to {"state", "since_ms", "station"}. A plug seen for
+    the first time only starts being tracked, it has no transition yet.
+    An event is {"plug", "station", "time_ms", "previous", "state"}, with
+    since_ms the time the plug got into the previous state.
+    """
+    events = []
+    for plug, (time_ms, state, station) in statuses.items():
+        known = plugs.get(plug)
+        if known is None:
+            plugs[plug] = {"state": state, "since_ms": time_ms, "station": station}
+        elif known["state"] != state and time_ms > known["since_ms"]:
+            events.append({"plug": plug, "station": station, "time_ms": time_ms, "previous": known["state"], "state": state, "since_ms": known["since_ms"]})
+            known["state"] = state
+            known["since_ms"] = time_ms
+    events.sort(key=lambda event: event["time_ms"])
+    return events
+
+def new_plug_metrics(started_ms):
+    """Hourly metrics per station, kept up to date from the events.
+
+    hours maps (station, hour start ms) to [free ms, occupied ms, charging
+    events]. The time of a plug is only counted from started_ms on, the
+    current state of each plug is still open and counted by hourly_metrics.
+    """
+    return {"started_ms": started_ms, "hours": {}}
+
+def add_interval(metrics, station, state, from_ms, to_ms):
+    """Add the time a plug spent in a state to the hourly buckets of its station."""
+    from_ms = max(from_ms, metrics["started_ms"])
+    while from_ms < to_ms:
+        hour = from_ms - from_ms % HOUR_MS
+        end = min(to_ms, hour + HOUR_MS)
+        bucket = metrics["hours"].setdefault((station, hour), [0, 0, 0])
+        bucket[0 if state == FREE else 1] += end - from_ms
+        from_ms = end
+
+def apply_event(metrics, event):
+    """Account a transition: the time spent in the previous state, and a charging event if the plug got occupied."""
+    add_interval(metrics, event["station"], event["previous"], event["since_ms"], event["time_ms"])
+    if event["state"] == OCCUPIED:
+        hour = event["time_ms"] - event["time_ms"] % HOUR_MS
+        metrics["hours"].setdefault((event["station"], hour), [0, 0, 0])[2] += 1
+
+def expire_hours(metrics, now_ms, retain_hours=RETAIN_HOURS):
+    oldest = now_ms - now_ms % HOUR_MS - retain_hours * HOUR_MS
+    for key in [key for key in metrics["hours"] if key[1] < oldest]:
+        del metrics["hours"][key]
+
+def hourly_metrics(metrics, plugs, now_ms):
+    """Availability percentage and charging events per station and hour, as {(station, hour ms): (availability, usage)}.
+
+    Includes the open intervals of the plugs up to now_ms, without changing metrics.
+    """
+    hours = {key: list(bucket) for key, bucket in metrics["hours"].items()}
+    current = {"started_ms": metrics["started_ms"], "hours": hours}
+    for plug in plugs.values():
+        add_interval(current, plug["station"], plug["state"], plug["since_ms"], now_ms)
+    return {key: ((free_ms / (free_ms + occupied_ms) * 100) if free_ms + occupied_ms else 0, events) for key, (free_ms, occupied_ms, events) in hours.items()}
+
+def poll_plugs(host, interval_sec=POLL_INTERVAL_SEC, on_events=None, iterations=None):
+    """Poll the plug statuses every interval_sec and keep the hourly metrics up to date from the transitions.
+
+    on_events(events, metrics, plugs) is called after every poll that had
+    transitions. Runs forever, or for the given number of polls. Returns the
+    metrics and the plugs.
+    """
+    plugs = {}
+    metrics = new_plug_metrics(round(time.time() * 1000))
+    polls = 0
+    next_poll = time.monotonic()
+    while iterations is None or polls < iterations:
+        try:
+            statuses = fetch_plug_statuses(host)
+        except requests.RequestException as e:
+            print(f"Error polling the plug statuses: {e}")
+            statuses = {}
+        events = diff_statuses(plugs, statuses)
+        for event in events:
+            apply_event(metrics, event)
+        expire_hours(metrics, round(time.time() * 1000))
+        if events and on_events is not None:
+            on_events(events, metrics, plugs)
+
+        polls += 1
+        if iterations is not None and polls >= iterations:
+            break
+        # Keep a fixed rate, however long the poll took
+        next_poll += interval_sec
+        time.sleep(max(0, next_poll - time.monotonic()))
+    return metrics, plugs
+
+def print_events(events, metrics, plugs):
+    now_ms = round(time.time() * 1000)
+    hour = now_ms - now_ms % HOUR_MS
+    for event in events:
+        print(f"Plug {event['plug']} of {event['station']}: {event['previous']} -> {event['state']}")
+    for (station, bucket_hour), (availability, usage) in sorted(hourly_metrics(metrics, plugs, now_ms).items()):
+        if bucket_hour == hour:
+            print(f"Station {station} this hour: availability {availability:.1f}%, {usage} charging events")
+
+def main():
+    read_host = "https://mobility.api.opendatahub.com/v2/flat%2Cnode"
+    poll_plugs(read_host, on_events=print_events)
+
+if __name__ == "__main__":
+    main()
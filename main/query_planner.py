@@ -0,0 +1,100 @@
+import time
+
+from history_store import get_charging_stations_status_incremental
+from series import SeriesBatch
+from metric_engine import compute_batch_metrics
+
+# How far before its window a carry_in metric looks for the state the window starts in
+CARRY_IN_HOURS = 1
+
+def declare_metric(name, compute, datatype, window_hours, station_ids, kernel=None, carry_in=False):
+    """A metric: compute(series) is run per station over the last window_hours of datatype (a StationSeries).
+
+    kernel names the vectorized version of compute in metric_engine.KERNELS,
+    used when all stations are computed at once. A carry_in metric also gets
+    the last measurement before its window, and is called as
+    compute(series, from_ms, to_ms), see resampling.
+    """
+    return {
+        "name": name,
+        "compute": compute,
+        "datatype": datatype,
+        "window_hours": window_hours,
+        "station_ids": station_ids,
+        "station_set": set(station_ids),
+        "kernel": kernel,
+        "carry_in": carry_in
+    }
+
+def fetch_hours(metric):
+    """How many hours of data a metric needs, including the look back of carry_in metrics."""
+    return metric["window_hours"] + (CARRY_IN_HOURS if metric["carry_in"] else 0)
+
+def plan_queries(metrics):
+    """Merge what the metrics need into the minimal set of queries.
+
+    Windows all end now, so the union of the windows of a station is the
+    longest one. Stations that need the same data type over the same window
+    share one query (which is then split into URL sized batches). Each query
+    also carries retain_hours, the longest window of its data type, so the
+    incremental store keeps what every metric needs.
+    """
+    windows = {}
+    retain_hours = {}
+    for metric in metrics:
+        datatype = metric["datatype"]
+        retain_hours[datatype] = max(retain_hours.get(datatype, 0), fetch_hours(metric))
+        for station_id in metric["station_ids"]:
+            key = (datatype, station_id)
+            windows[key] = max(windows.get(key, 0), fetch_hours(metric))
+
+    queries = {}
+    for (datatype, station_id), window_hours in windows.items():
+        query = queries.setdefault((datatype, window_hours), {
+            "datatype": datatype,
+            "window_hours": window_hours,
+            "retain_hours": retain_hours[datatype],
+            "station_ids": []
+        })
+        query["station_ids"].append(station_id)
+    return list(queries.values())
+
+def execute_plan(host, station_type, queries, store):
+    """Run the queries through the incremental store. Returns the shared series as a SeriesBatch."""
+    shared = SeriesBatch()
+    for query in queries:
+        histories = get_charging_stations_status_incremental(host, station_type, query["station_ids"], query["datatype"], query["window_hours"], store, retain_hours=query["retain_hours"])
+        for station_id, station_series in histories.items():
+            shared.put(station_id, query["datatype"], station_series)
+    return shared
+
+def metric_view(shared, metric, station_id, now_ms):
+    """The series of a station in the window of a metric, a slice of the shared series."""
+    return shared.get(station_id, metric["datatype"]).slice(now_ms - metric["window_hours"] * 3600 * 1000, carry_in=metric["carry_in"])
+
+def compute_metric(metric, shared, station_id, now_ms):
+    view = metric_view(shared, metric, station_id, now_ms)
+    if metric["carry_in"]:
+        return metric["compute"](view, now_ms - metric["window_hours"] * 3600 * 1000, now_ms)
+    return metric["compute"](view)
+
+def compute_station_metrics(metrics, shared, station_id, now_ms=None):
+    """Run the metrics of a station over its views of the shared series. Returns {metric name: value}."""
+    if now_ms is None:
+        now_ms = round(time.time() * 1000)
+    return {metric["name"]: compute_metric(metric, shared, station_id, now_ms) for metric in metrics if station_id in metric["station_set"]}
+
+def compute_metrics(metrics, shared, now_ms=None, station_ids=None):
+    """Run every metric over its view of the shared series. Returns {station: {metric name: value}}.
+
+    Computes the given stations, all stations of the metrics by default. If
+    every metric has a kernel, they are computed at once by the metric engine.
+    """
+    if now_ms is None:
+        now_ms = round(time.time() * 1000)
+    if station_ids is None:
+        station_ids = list(dict.fromkeys(station_id for metric in metrics for station_id in metric["station_ids"]))
+    if all(metric["kernel"] for metric in metrics):
+        results = compute_batch_metrics(metrics, shared, now_ms, station_ids)
+        return {station_id: results.get(station_id, {}) for station_id in station_ids}
+    return {station_id: compute_station_metrics(metrics, shared, station_id, now_ms) for station_id in station_ids}
@@ -0,0 +1,219 @@
+import json
+import math
+import mmap
+import os
+import shutil
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from urllib.parse import quote
+
+from adaptive_fetch import get_charging_stations_status_adaptive
+from ninja_reader import DEFAULT_SELECT, format_query_date, parse_query_date
+from series import StationSeries
+from timestamps import parse_mvalidtime
+
+# Where the cached measurement ranges are kept, and how big the cache may grow
+RANGE_CACHE_PATH = "state/range_cache"
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# Measurements can show up in Ninja with some delay, so the last minutes
+# before now are never cached and get fetched again next time
+SETTLE_MS = 15 * 60 * 1000
+
+def open_range_cache(path=RANGE_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+    """Open the range cache in path. Only the index is read, the columns are mapped on use.
+
+    The cache can be shared by threads, its index and files are only touched
+    under its lock.
+    """
+    index = {}
+    index_path = os.path.join(path, "index.json")
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    return {"path": path, "max_bytes": max_bytes, "index": index, "lock": threading.Lock()}
+
+def save_range_cache_index(cache):
+    os.makedirs(cache["path"], exist_ok=True)
+    index_path = os.path.join(cache["path"], "index.json")
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump(cache["index"], f)
+    os.replace(f"{index_path}.tmp", index_path)
+
+def cache_key(station_type, station_id, datatype):
+    return "/".join(quote(part, safe='') for part in (station_type, datatype, station_id))
+
+def entry_dir(cache, key):
+    return os.path.join(cache["path"], *key.split("/"))
+
+def map_column(path, typecode):
+    """Memory map a column file. Nothing is read until the values are used."""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return array(typecode)
+    with open(path, "rb") as f:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+
+def read_entry(cache, key):
+    """The memory mapped times (epoch ms, int64) and values (float64) of a cache entry."""
+    if key not in cache["index"]:
+        return array('q'), array('d')
+    directory = entry_dir(cache, key)
+    return map_column(os.path.join(directory, "times.i64"), 'q'), map_column(os.path.join(directory, "values.f64"), 'd')
+
+def add_range(ranges, from_ms, to_ms):
+    """Add [from_ms, to_ms) to a sorted list of disjoint ranges, merging overlapping and touching ones."""
+    merged = []
+    for start, end in sorted(ranges + [[from_ms, to_ms]]):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def find_gaps(ranges, from_ms, to_ms):
+    """The parts of [from_ms, to_ms) not covered by the sorted ranges."""
+    gaps = []
+    position = from_ms
+    for start, end in ranges:
+        if end <= position:
+            continue
+        if start >= to_ms:
+            break
+        if start > position:
+            gaps.append([position, start])
+        position = end
+    if position < to_ms:
+        gaps.append([position, to_ms])
+    return gaps
+
+def write_entry(cache, key, rows, covered):
+    """Add fetched rows to a cache entry and mark the covered ranges as cached.
+
+    rows must all lie in the covered ranges, which keeps every append newer
+    than what the entry already has.
+    """
+    directory = entry_dir(cache, key)
+    os.makedirs(directory, exist_ok=True)
+    times_path = os.path.join(directory, "times.i64")
+    values_path = os.path.join(directory, "values.f64")
+
+    times, values = read_entry(cache, key)
+    points = sorted((parse_mvalidtime(row['mvalidtime']), math.nan if row['mvalue'] is None else float(row['mvalue'])) for row in rows)
+
+    if points and (len(times) == 0 or points[0][0] > times[-1]):
+        # Newer than everything cached, the common case: append to the columns
+        with open(times_path, "ab") as f:
+            array('q', [t for t, v in points]).tofile(f)
+        with open(values_path, "ab") as f:
+            array('d', [v for t, v in points]).tofile(f)
+    elif points:
+        # Backfill before or between cached ranges: rewrite the merged columns
+        merged = dict(zip(times, values))
+        merged.update(points)
+        merged_times = sorted(merged)
+        for path, column in ((times_path, array('q', merged_times)), (values_path, array('d', [merged[t] for t in merged_times]))):
+            with open(f"{path}.tmp", "wb") as f:
+                column.tofile(f)
+            os.replace(f"{path}.tmp", path)
+
+    entry = cache["index"].setdefault(key, {"ranges": [], "bytes": 0, "last_used": 0})
+    for from_ms, to_ms in covered:
+        entry["ranges"] = add_range(entry["ranges"], from_ms, to_ms)
+    entry["bytes"] = sum(os.path.getsize(path) for path in (times_path, values_path) if os.path.exists(path))
+
+def get_cached_columns(cache, key, from_ms, to_ms):
+    """Times and values of a cache entry in [from_ms, to_ms), as zero copy slices of the mapped columns."""
+    times, values = read_entry(cache, key)
+    start = bisect_left(times, from_ms)
+    end = bisect_left(times, to_ms)
+    if key in cache["index"]:
+        cache["index"][key]["last_used"] = round(time.time() * 1000)
+    return times[start:end], values[start:end]
+
+def evict_cold_entries(cache, keep=()):
+    """Remove the least recently used entries until the cache is below its size cap."""
+    total = sum(entry["bytes"] for entry in cache["index"].values())
+    for key in sorted(cache["index"], key=lambda key: cache["index"][key]["last_used"]):
+        if total <= cache["max_bytes"]:
+            break
+        if key in keep:
+            continue
+        total -= cache["index"].pop(key)["bytes"]
+        shutil.rmtree(entry_dir(cache, key), ignore_errors=True)
+
+def get_charging_stations_status_cached(host, station_type, from_date, to_date, station_ids, datatype, cache, select=DEFAULT_SELECT, failed=None):
+    """Get the history of many stations through the range cache.
+
+    Only the parts of [from_date, to_date) that aren't cached yet are fetched
+    from Ninja, stations with the same gap are fetched together. A station
+    that is already cached is fetched from the end of its cached ranges on,
+    even if from_date is later: incremental runs only ask for the last
+    minutes, which are never settled, and this way the minutes that settled
+    since the previous run get cached too. Gaps are fetched in adaptively
+    sized chunks, so backfills of long ranges don't run into Ninja's
+    response size and query time limits. The fetched measurements of the
+    last SETTLE_MS are returned, but not cached.
+
+    Returns a dict mapping every station code to its StationSeries in
+    [from_date, to_date). Stations whose fetch failed get an empty one, and
+    are added to the failed list if one is given.
+    """
+    from_ms = parse_query_date(from_date)
+    to_ms = parse_query_date(to_date)
+    settled_ms = round(time.time() * 1000) - SETTLE_MS
+    keys = {station_id: cache_key(station_type, station_id, datatype) for station_id in station_ids}
+
+    gap_stations = {}
+    with cache["lock"]:
+        for station_id, key in keys.items():
+            ranges = cache["index"].get(key, {}).get("ranges", [])
+            station_from_ms = min(from_ms, ranges[-1][1]) if ranges else from_ms
+            for gap_from, gap_to in find_gaps(ranges, station_from_ms, to_ms):
+                gap_stations.setdefault((gap_from, gap_to), []).append(station_id)
+
+    fetched = {}
+    fresh = {}
+    failed_stations = set()
+    for (gap_from, gap_to), stations in gap_stations.items():
+        gap_failed = []
+        series = get_charging_stations_status_adaptive(host, station_type, format_query_date(gap_from), format_query_date(gap_to), stations, [datatype], select, failed=gap_failed)
+        failed_stations.update(gap_failed)
+        for station_id in stations:
+            if station_id in failed_stations:
+                continue
+            rows, covered = fetched.setdefault(station_id, ([], []))
+            for row in series[station_id]:
+                row_ms = parse_mvalidtime(row['mvalidtime'])
+                if row_ms < settled_ms:
+                    rows.append(row)
+                elif from_ms <= row_ms < to_ms:
+                    fresh.setdefault(station_id, []).append((row_ms, row['mvalue']))
+            if gap_from < settled_ms:
+                covered.append([gap_from, min(gap_to, settled_ms)])
+
+    result = {}
+    with cache["lock"]:
+        for station_id, (rows, covered) in fetched.items():
+            if station_id not in failed_stations:
+                write_entry(cache, keys[station_id], rows, covered)
+
+        for station_id, key in keys.items():
+            if station_id in failed_stations:
+                result[station_id] = StationSeries()
+                continue
+            times, values = get_cached_columns(cache, key, from_ms, to_ms)
+            station_series = result[station_id] = StationSeries()
+            station_series.times.frombytes(times.tobytes())
+            station_series.values.frombytes(values.tobytes())
+            # The fresh measurements are all newer than the cached (settled) ones
+            for time_ms, value in sorted(fresh.get(station_id, []), key=lambda point: point[0]):
+                station_series.append(time_ms, math.nan if value is None else value)
+
+        evict_cold_entries(cache, set(keys.values()))
+        save_range_cache_index(cache)
+
+    if failed is not None:
+        failed.extend(station_id for station_id in station_ids if station_id in failed_stations)
+    return result
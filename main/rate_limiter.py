@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+# Starting point and bounds of the per host limits. The controller moves
+# between them on its own, see AimdController.
+INITIAL_RATE = 10.0
+MIN_RATE = 1.0
+MAX_RATE = 200.0
+RATE_STEP = 2.0
+INITIAL_LIMIT = 4
+MIN_LIMIT = 1
+MAX_LIMIT = 64
+
+# Completed requests per adjustment, and how much the p95 latency of a window
+# may exceed the best p95 seen before it counts as rising
+WINDOW = 20
+LATENCY_TOLERANCE = 1.5
+DECREASE_FACTOR = 0.5
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, with bursts of up to `burst` requests."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class AimdController:
+    """Additive increase / multiplicative decrease of the requests in flight and the request rate of one host.
+
+    After every WINDOW successful requests the limits go up by one step,
+    unless the p95 latency of the window rose above LATENCY_TOLERANCE times
+    the best p95 seen so far. Then, like on a 429 or 5xx response, they are
+    halved, at most once per window.
+    """
+
+    def __init__(self, limit=INITIAL_LIMIT, rate=INITIAL_RATE):
+        self.limit = limit
+        self.bucket = TokenBucket(rate)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.latencies = deque(maxlen=WINDOW)
+        self.best_p95 = None
+        self.samples = 0
+        self.since_decrease = WINDOW
+        self.stats = {"requests": 0, "throttled": 0, "increases": 0, "decreases": 0}
+
+    def acquire(self):
+        """Wait for a free slot and a token of the rate limit."""
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+        self.bucket.acquire()
+
+    def release(self, seconds, status):
+        """Give the slot back and feed the controller with the latency and status (None if the request failed) of the response."""
+        with self.condition:
+            self.in_flight -= 1
+            self.stats["requests"] += 1
+            self.since_decrease += 1
+            if status is None or status == 429 or status >= 500:
+                self.stats["throttled"] += 1
+                self.decrease()
+            else:
+                self.latencies.append(seconds)
+                self.samples += 1
+                if self.samples >= WINDOW:
+                    self.samples = 0
+                    p95 = percentile(self.latencies, 0.95)
+                    # The best p95 slowly drifts up, so a lasting slowdown of the host becomes the new normal
+                    if self.best_p95 is None or p95 < self.best_p95:
+                        self.best_p95 = p95
+                    else:
+                        self.best_p95 *= 1.05
+                    if p95 > self.best_p95 * LATENCY_TOLERANCE:
+                        self.decrease()
+                    else:
+                        self.increase()
+            self.condition.notify_all()
+
+    def increase(self):
+        self.limit = min(MAX_LIMIT, self.limit + 1)
+        self.bucket.rate = min(MAX_RATE, self.bucket.rate + RATE_STEP)
+        self.bucket.burst = self.bucket.rate
+        self.stats["increases"] += 1
+
+    def decrease(self):
+        # Responses of requests sent before the last decrease don't count again
+        if self.since_decrease < WINDOW:
+            return
+        self.since_decrease = 0
+        self.samples = 0
+        self.limit = max(MIN_LIMIT, int(self.limit * DECREASE_FACTOR))
+        self.bucket.rate = max(MIN_RATE, self.bucket.rate * DECREASE_FACTOR)
+        self.bucket.burst = self.bucket.rate
+        self.stats["decreases"] += 1
+
+    def current_limits(self):
+        return {
+            "limit": self.limit,
+            "rate": round(self.bucket.rate, 1),
+            "in_flight": self.in_flight,
+            "p95_ms": round(percentile(self.latencies, 0.95) * 1000) if self.latencies else None,
+            **self.stats
+        }
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+# One controller per host, shared by all clients and threads
+controllers = {}
+controllers_lock = threading.Lock()
+
+def get_controller(url):
+    netloc = urlsplit(url).netloc or url
+    with controllers_lock:
+        if netloc not in controllers:
+            controllers[netloc] = AimdController()
+        return controllers[netloc]
+
+def limiter_stats():
+    """The current limits and counters of every host, see AimdController.current_limits."""
+    with controllers_lock:
+        return {netloc: controller.current_limits() for netloc, controller in controllers.items()}
+
+def print_limiter_stats():
+    for netloc, limits in limiter_stats().items():
+        print(f"{netloc}: {limits['limit']} in flight at {limits['rate']} req/s, p95 {limits['p95_ms']} ms, "
+              f"{limits['requests']} requests, {limits['throttled']} throttled, {limits['increases']} increases, {limits['decreases']} decreases")
@@ -0,0 +1,57 @@
+import math
+from bisect import bisect_left
+
+def transitions(times, values):
+    """Only the change points of a series: the first measurement and every one whose value differs from the previous one.
+
+    Forward filling the change points gives the same series back, so they
+    are all the time weighted metrics need.
+    """
+    changed_times = []
+    changed_values = []
+    for time_ms, value in zip(times, values):
+        if not changed_values or value != changed_values[-1]:
+            changed_times.append(time_ms)
+            changed_values.append(value)
+    return changed_times, changed_values
+
+def state_segments(times, values, from_ms, to_ms):
+    """Forward fill a series into (start, end, value) segments, clipped to [from_ms, to_ms).
+
+    Every value holds until the next measurement (or to_ms). The last
+    measurement before from_ms is carried into the window, without one the
+    window starts at the first measurement. Unknown (NaN) values are left out.
+    """
+    # The carried in measurement is the last one before the window
+    first = max(0, bisect_left(times, from_ms) - 1)
+    segments = []
+    for i in range(first, len(times)):
+        start = max(times[i], from_ms)
+        end = min(times[i + 1] if i + 1 < len(times) else to_ms, to_ms)
+        if start >= to_ms:
+            break
+        value = values[i]
+        if end > start and not (isinstance(value, float) and math.isnan(value)):
+            segments.append((start, end, value))
+    return segments
+
+def time_weighted_fraction(times, values, from_ms, to_ms, predicate):
+    """Fraction of the known time of [from_ms, to_ms) in which predicate(value) holds, and the known time in ms.
+
+    Works on raw and on transition compressed series alike. The fraction is
+    None if nothing is known about the window.
+    """
+    known_ms = 0
+    true_ms = 0
+    for start, end, value in state_segments(times, values, from_ms, to_ms):
+        known_ms += end - start
+        if predicate(value):
+            true_ms += end - start
+    return (true_ms / known_ms if known_ms else None), known_ms
+
+def compute_time_weighted_availability(series, from_ms, to_ms):
+    """Percentage of the time in the window with a value > 0 (a StationSeries with a carried in measurement, see metric_view)."""
+    fraction, known_ms = time_weighted_fraction(series.times, series.values, from_ms, to_ms, lambda value: value > 0)
+    if fraction is None:
+        return 0  # No data available
+    return fraction * 100
@@ -0,0 +1,181 @@
+import math
+from array import array
+from bisect import bisect_left
+
+from timestamps import parse_mvalidtime, parse_mvalidtimes
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class Dictionary:
+    """Dictionary encoding of strings (station codes, data types) to small ints."""
+
+    def __init__(self):
+        self.strings = []
+        self.codes = {}
+
+    def encode(self, string):
+        code = self.codes.get(string)
+        if code is None:
+            code = len(self.strings)
+            self.codes[string] = code
+            self.strings.append(string)
+        return code
+
+    def lookup(self, string):
+        """The code of a string, None if it was never encoded."""
+        return self.codes.get(string)
+
+    def decode(self, code):
+        return self.strings[code]
+
+    def __len__(self):
+        return len(self.strings)
+
+class StationSeries:
+    """Time series of one station and data type.
+
+    Times (epoch ms, int64) and values (float64) are kept in two contiguous
+    arrays, oldest first: 16 bytes per measurement instead of a dict per row.
+    """
+    __slots__ = ("station", "datatype", "times", "values")
+
+    def __init__(self, station=0, datatype=0, times=None, values=None):
+        self.station = station
+        self.datatype = datatype
+        self.times = times if times is not None else array('q')
+        self.values = values if values is not None else array('d')
+
+    @classmethod
+    def from_rows(cls, rows, station=0, datatype=0):
+        """Build a series from decoded Ninja rows (with mvalidtime and mvalue), oldest first. A null mvalue becomes NaN."""
+        return cls(station, datatype, parse_mvalidtimes(row['mvalidtime'] for row in rows), array('d', (math.nan if row['mvalue'] is None else row['mvalue'] for row in rows)))
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, time_ms, value):
+        """Add a measurement. Measurements have to be appended oldest first, see merge otherwise."""
+        self.times.append(time_ms)
+        self.values.append(value)
+
+    def extend(self, times, values):
+        self.times.extend(times)
+        self.values.extend(values)
+
+    def slice(self, from_ms, to_ms=None, carry_in=False):
+        """The measurements in [from_ms, to_ms), as a new series. With carry_in, also the last one before from_ms."""
+        start = bisect_left(self.times, from_ms)
+        if carry_in and start > 0:
+            start -= 1
+        end = len(self.times) if to_ms is None else bisect_left(self.times, to_ms)
+        return StationSeries(self.station, self.datatype, self.times[start:end], self.values[start:end])
+
+    def merge(self, other):
+        """Merge the measurements of other into a new series. On equal times, other wins."""
+        if len(other) == 0 or (len(self) > 0 and other.times[0] > self.times[-1]):
+            merged = StationSeries(self.station, self.datatype, array('q', self.times), array('d', self.values))
+            merged.extend(other.times, other.values)
+            return merged
+        points = dict(zip(self.times, self.values))
+        points.update(zip(other.times, other.values))
+        times = sorted(points)
+        return StationSeries(self.station, self.datatype, array('q', times), array('d', [points[t] for t in times]))
+
+    def as_numpy(self):
+        """(times, values) as NumPy arrays sharing the memory of the series. Needs NumPy."""
+        return np.frombuffer(self.times, dtype=np.int64), np.frombuffer(self.values, dtype=np.float64)
+
+    @property
+    def nbytes(self):
+        return self.times.itemsize * len(self.times) + self.values.itemsize * len(self.values)
+
+class SeriesBatch:
+    """The series of many stations and data types, with dictionary encoded station codes and data types."""
+
+    def __init__(self):
+        self.stations = Dictionary()
+        self.datatypes = Dictionary()
+        self.series = {}
+
+    def get(self, station_code, datatype):
+        """The series of a station and data type, an empty one if there is none."""
+        series = self.series.get((self.stations.lookup(station_code), self.datatypes.lookup(datatype)))
+        return series if series is not None else StationSeries()
+
+    def put(self, station_code, datatype, series):
+        """Set the series of a station and data type, replacing what's there."""
+        series.station = self.stations.encode(station_code)
+        series.datatype = self.datatypes.encode(datatype)
+        self.series[(series.station, series.datatype)] = series
+
+    def put_rows(self, station_code, datatype, rows):
+        self.put(station_code, datatype, StationSeries.from_rows(rows))
+
+    def add_rows(self, rows, datatype=None):
+        """Append decoded Ninja rows of any stations, oldest first per station. Rows without tname are of datatype."""
+        for row in rows:
+            station = self.stations.encode(row['scode'])
+            datatype_code = self.datatypes.encode(row.get('tname', datatype))
+            series = self.series.get((station, datatype_code))
+            if series is None:
+                series = self.series[(station, datatype_code)] = StationSeries(station, datatype_code)
+            series.append(parse_mvalidtime(row['mvalidtime']), row['mvalue'])
+
+    def select(self, station_codes):
+        """The series of some stations as a new batch, with its own dictionaries.
+
+        The series share their measurements with this batch, which makes it a
+        cheap snapshot, as long as neither batch appends to them afterwards.
+        """
+        batch = SeriesBatch()
+        for station_code in station_codes:
+            station = self.stations.lookup(station_code)
+            if station is None:
+                continue
+            for datatype_code, datatype in enumerate(self.datatypes.strings):
+                series = self.series.get((station, datatype_code))
+                if series is not None:
+                    batch.put(station_code, datatype, StationSeries(times=series.times, values=series.values))
+        return batch
+
+    def slice(self, from_ms, to_ms=None):
+        """All series cut to [from_ms, to_ms), as a new batch sharing the dictionaries."""
+        batch = SeriesBatch()
+        batch.stations = self.stations
+        batch.datatypes = self.datatypes
+        batch.series = {key: series.slice(from_ms, to_ms) for key, series in self.series.items()}
+        return batch
+
+    def merge(self, other):
+        """Merge the series of another batch into this one."""
+        for (station, datatype_code), series in other.series.items():
+            station_code = other.stations.decode(station)
+            datatype = other.datatypes.decode(datatype_code)
+            self.put(station_code, datatype, self.get(station_code, datatype).merge(series))
+
+    def flatten(self):
+        """All measurements as four columns (station, data type, time, value), sorted by station, data type and time."""
+        stations = array('i')
+        datatypes = array('i')
+        times = array('q')
+        values = array('d')
+        for key in sorted(self.series):
+            series = self.series[key]
+            stations.extend([key[0]] * len(series))
+            datatypes.extend([key[1]] * len(series))
+            times.extend(series.times)
+            values.extend(series.values)
+        return stations, datatypes, times, values
+
+    @property
+    def nbytes(self):
+        return sum(series.nbytes for series in self.series.values())
+
+def measurement_values(data):
+    """The values of a StationSeries, or the mvalue of every row of a list of rows."""
+    if isinstance(data, StationSeries):
+        return data.values
+    return [entry.get('mvalue') for entry in data]
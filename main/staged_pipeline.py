@@ -0,0 +1,92 @@
+import queue
+import threading
+
+# Items waiting between two stages. When a queue is full the stage feeding it
+# blocks, so a slow stage holds back the ones before it instead of piling up work.
+DEFAULT_QUEUE_SIZE = 32
+
+# Tells a worker there's no more input
+STOP = object()
+
+class StagedPipeline:
+    """Threaded producer/consumer pipeline.
+
+    stages is a list of (name, func, workers). Each stage has its own pool of
+    worker threads and reads from a bounded input queue. func(item) returns a
+    list of items for the next stage, what the last stage returns is collected
+    as the result of run(). Items whose stage raised are dropped, and kept in
+    failed as (stage name, item, error).
+    """
+
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.max_depths = {name: 0 for name, func, workers in stages}
+        self.errors = {name: 0 for name, func, workers in stages}
+        self.failed = []
+        self.results = []
+
+    def queue_depths(self):
+        """Current number of items waiting in front of each stage."""
+        return {name: stage_queue.qsize() for (name, func, workers), stage_queue in zip(self.stages, self.queues)}
+
+    def print_queue_depths(self):
+        depths = self.queue_depths()
+        print("Pipeline queue depth: " + ", ".join(f"{name} {depths[name]} (max {self.max_depths[name]})" for name in depths))
+
+    def put(self, index, item):
+        stage_queue = self.queues[index]
+        stage_queue.put(item)
+        name = self.stages[index][0]
+        self.max_depths[name] = max(self.max_depths[name], stage_queue.qsize())
+
+    def work(self, index):
+        name, func, workers = self.stages[index]
+        while True:
+            item = self.queues[index].get()
+            if item is STOP:
+                return
+            try:
+                outputs = func(item)
+            except Exception as e:
+                print(f"Error in pipeline stage {name}: {e}")
+                self.errors[name] += 1
+                self.failed.append((name, item, e))
+                continue
+            for output in outputs:
+                if index + 1 < len(self.stages):
+                    self.put(index + 1, output)
+                else:
+                    self.results.append(output)
+
+    def run(self, items, report_every=None):
+        """Feed items through all stages and return the outputs of the last one.
+
+        With report_every (seconds), the queue depths are printed periodically,
+        the stage in front of the longest queue is the bottleneck.
+        """
+        threads = []
+        for index, (name, func, workers) in enumerate(self.stages):
+            threads.append([threading.Thread(target=self.work, args=(index,), name=f"{name}-{i}", daemon=True) for i in range(workers)])
+            for thread in threads[index]:
+                thread.start()
+
+        done = threading.Event()
+        if report_every:
+            def report():
+                while not done.wait(report_every):
+                    self.print_queue_depths()
+            threading.Thread(target=report, daemon=True).start()
+
+        for item in items:
+            self.put(0, item)
+
+        # Stop the stages in order, each once the one before it is drained
+        for index, (name, func, workers) in enumerate(self.stages):
+            for _ in range(workers):
+                self.queues[index].put(STOP)
+            for thread in threads[index]:
+                thread.join()
+
+        done.set()
+        return self.results
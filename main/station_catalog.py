@@ -0,0 +1,140 @@
+import json
+import os
+import time
+
+from ninja_reader import DEFAULT_BATCH_SIZE, build_scode_filter, iter_pages
+from aggregates import get_aggregates
+
+# Where the catalog is kept between runs, and after how long it is fully
+# refreshed. In between, only stations it doesn't know yet are fetched.
+CATALOG_PATH = "state/catalog.json"
+CATALOG_TTL_SEC = 24 * 3600
+
+PLUG_STATION_TYPE = "EChargingPlug"
+
+STATION_SELECT = "scode,sname,scoordinate,sorigin,sactive,smetadata"
+
+def new_catalog():
+    return {"refreshed_ms": None, "stations": {}}
+
+def load_catalog(path=CATALOG_PATH):
+    """Load the catalog of the previous runs and index it."""
+    if not os.path.exists(path):
+        return index_catalog(new_catalog())
+    with open(path) as f:
+        return index_catalog(json.load(f))
+
+def save_catalog(catalog, path=CATALOG_PATH):
+    """Write the catalog (without its indexes) to a temporary file first, so a crashed run never leaves a half written one."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"refreshed_ms": catalog["refreshed_ms"], "stations": catalog["stations"]}, f)
+    os.replace(tmp_path, path)
+
+def index_catalog(catalog):
+    """(Re)build the in memory indexes by origin and municipality."""
+    catalog["by_origin"] = {}
+    catalog["by_municipality"] = {}
+    for code, station in catalog["stations"].items():
+        catalog["by_origin"].setdefault(station["origin"], []).append(code)
+        catalog["by_municipality"].setdefault(station["municipality"], []).append(code)
+    return catalog
+
+def station_from_row(row, plugs=0):
+    """A catalog entry from a Ninja station row."""
+    coordinate = row.get('scoordinate') or {}
+    metadata = row.get('smetadata') or {}
+    return {
+        "code": row['scode'],
+        "name": row.get('sname', row['scode']),
+        "latitude": coordinate.get('y'),
+        "longitude": coordinate.get('x'),
+        "municipality": metadata.get('municipality', metadata.get('city')),
+        "origin": row.get('sorigin'),
+        "active": row.get('sactive', True),
+        "plugs": plugs
+    }
+
+def fetch_stations(host, station_type, station_ids=None):
+    """The station rows of a type, all of them or only the given codes (in batches)."""
+    url = f"{host}/{station_type}?select={STATION_SELECT}&limit={{limit}}&offset={{offset}}{{where}}&shownull=false&distinct=true"
+    if station_ids is None:
+        wheres = [""]
+    else:
+        wheres = [f"&where={build_scode_filter(station_ids[i:i + DEFAULT_BATCH_SIZE])}" for i in range(0, len(station_ids), DEFAULT_BATCH_SIZE)]
+    rows = []
+    for where in wheres:
+        for data in iter_pages(lambda limit, offset: url.format(limit=limit, offset=offset, where=where)):
+            rows.extend(data)
+    return rows
+
+def fetch_plug_counts(host, station_ids=None):
+    """Number of active plugs per station code, counted by Ninja."""
+    url = f"{host}/{PLUG_STATION_TYPE}?select={{select}}&limit={{limit}}&offset={{offset}}&where=sactive.eq.true{{where}}&shownull=false"
+    if station_ids is None:
+        wheres = [""]
+    else:
+        wheres = ["," + build_scode_filter(station_ids[i:i + DEFAULT_BATCH_SIZE]).replace("scode.", "pcode.", 1) for i in range(0, len(station_ids), DEFAULT_BATCH_SIZE)]
+    counts = {}
+    for where in wheres:
+        for row in get_aggregates(lambda select, limit, offset: url.format(select=select, limit=limit, offset=offset, where=where), ["pcode"], ["count(scode)"]):
+            if "pcode" in row:
+                counts[row['pcode']] = row['count(scode)']
+    return counts
+
+def refresh_catalog(catalog, host, station_type):
+    """Replace the catalog with all stations of the type."""
+    counts = fetch_plug_counts(host)
+    catalog["stations"] = {row['scode']: station_from_row(row, counts.get(row['scode'], 0)) for row in fetch_stations(host, station_type)}
+    catalog["refreshed_ms"] = round(time.time() * 1000)
+    index_catalog(catalog)
+
+def update_catalog(catalog, host, station_type, active_ids):
+    """Apply a delta: fetch the stations of active_ids that aren't known yet and update the active flags.
+
+    Returns whether the catalog changed.
+    """
+    active_set = set(active_ids)
+    changed = False
+    for code, station in catalog["stations"].items():
+        if station["active"] != (code in active_set):
+            station["active"] = code in active_set
+            changed = True
+
+    missing = [code for code in active_ids if code not in catalog["stations"]]
+    if missing:
+        counts = fetch_plug_counts(host, missing)
+        for row in fetch_stations(host, station_type, missing):
+            catalog["stations"][row['scode']] = station_from_row(row, counts.get(row['scode'], 0))
+        index_catalog(catalog)
+        changed = True
+    return changed
+
+def get_catalog(host, station_type, active_ids=None, path=CATALOG_PATH, ttl_sec=CATALOG_TTL_SEC):
+    """The station catalog: loaded from disk, fully refreshed once it is older than ttl_sec, otherwise updated with a delta for active_ids."""
+    catalog = load_catalog(path)
+    refreshed_ms = catalog["refreshed_ms"]
+    if refreshed_ms is None or time.time() * 1000 - refreshed_ms > ttl_sec * 1000:
+        refresh_catalog(catalog, host, station_type)
+        if active_ids is not None:
+            update_catalog(catalog, host, station_type, active_ids)
+        save_catalog(catalog, path)
+    elif active_ids is not None and update_catalog(catalog, host, station_type, active_ids):
+        save_catalog(catalog, path)
+    return catalog
+
+def get_station(catalog, code):
+    """The catalog entry of a station, None if unknown."""
+    return catalog["stations"].get(code)
+
+def stations_by_origin(catalog, origin):
+    return [catalog["stations"][code] for code in catalog["by_origin"].get(origin, [])]
+
+def stations_by_municipality(catalog, municipality):
+    return [catalog["stations"][code] for code in catalog["by_municipality"].get(municipality, [])]
+
+def active_station_codes(catalog):
+    return [code for code, station in catalog["stations"].items() if station["active"]]
@@ -1,5 +1,7 @@
 import requests
 
+from aggregates import get_aggregates
+
 def print_response_details(current_step, response):
     """Helper function to print the details of the response."""
     print(f"Step: {current_step}")
@@ -130,34 +132,23 @@ def main():
     #4 Get station type:
     host = "https://mobility.api.opendatahub.com"
     endpoint = "/v2/flat%2Cnode/%2A"
-    params = {
-        'limit': -1,
-        'offset': 0,
-        'shownull': False,
-        'distinct': True
-    }
-    headers = {'accept': 'application/json'}
-
-    url = f"{host}{endpoint}"
-    response = requests.get(url, params=params, headers=headers)
-
-    if response.status_code == 200:
-        json_response = response.json()
-        
-        active_count = 0
-        inactive_count = 0
-        
-        for station in json_response['data']:
-            if station.get('pactive', True):
-                active_count += 1
+    url = f"{host}{endpoint}?limit={{limit}}&offset={{offset}}&select={{select}}&shownull=false&distinct=true"
+
+    # Let Ninja count the stations by pactive, one small response instead of all stations
+    active_count = 0
+    inactive_count = 0
+    try:
+        for group in get_aggregates(lambda select, limit, offset: url.format(select=select, limit=limit, offset=offset), ['pactive'], ['count(scode)']):
+            if group.get('pactive', True):
+                active_count += group['count(scode)']
             else:
-                inactive_count += 1
-        
+                inactive_count += group['count(scode)']
+
         print(f"Active Stations: {active_count}")
         print(f"Inactive Stations: {inactive_count}")
         print(f"Total Stations: {active_count+inactive_count}")
-    else:
-        print(f"Error: {response.status_code}")
+    except requests.RequestException as e:
+        print(f"Error: {e}")
     
 
 
@@ -0,0 +1,78 @@
+import calendar
+from array import array
+from datetime import datetime
+
+# Formats of mvalidtime in Ninja responses (with and without milliseconds)
+MVALIDTIME_FORMATS = ["%Y-%m-%d %H:%M:%S.%f%z", "%Y-%m-%d %H:%M:%S%z"]
+
+# `2024-05-01 12:34:56.000+0000` and `2024-05-01 12:34:56+0000`
+MVALIDTIME_LENGTH = 28
+MVALIDTIME_LENGTH_NO_MS = 24
+
+# Epoch ms of the start of an hour by its `2024-05-01 12` prefix. Measurements
+# of a window share a few dozen hours, so this stays small; it is cleared
+# when it reaches HOUR_CACHE_SIZE anyway.
+HOUR_CACHE_SIZE = 100000
+hour_cache = {}
+
+# Offset in ms by its `+0000` suffix
+offset_cache = {}
+
+def parse_mvalidtime_strptime(mvalidtime):
+    """Convert a Ninja mvalidtime string to epoch milliseconds with strptime. Slow, but takes any valid format."""
+    for date_format in MVALIDTIME_FORMATS:
+        try:
+            return round(datetime.strptime(mvalidtime, date_format).timestamp() * 1000)
+        except ValueError:
+            pass
+    raise ValueError(f"Unknown mvalidtime format: {mvalidtime}")
+
+def hour_ms(prefix):
+    """Epoch ms of a `2024-05-01 12` prefix (UTC)."""
+    epoch_ms = hour_cache.get(prefix)
+    if epoch_ms is None:
+        if prefix[4] != "-" or prefix[7] != "-" or prefix[10] != " ":
+            raise ValueError(prefix)
+        epoch_ms = calendar.timegm((int(prefix[0:4]), int(prefix[5:7]), int(prefix[8:10]), int(prefix[11:13]), 0, 0)) * 1000
+        if len(hour_cache) >= HOUR_CACHE_SIZE:
+            hour_cache.clear()
+        hour_cache[prefix] = epoch_ms
+    return epoch_ms
+
+def offset_ms(suffix):
+    """Milliseconds of a `+0200` UTC offset."""
+    epoch_ms = offset_cache.get(suffix)
+    if epoch_ms is None:
+        if suffix[0] not in "+-":
+            raise ValueError(suffix)
+        epoch_ms = (int(suffix[1:3]) * 60 + int(suffix[3:5])) * 60000
+        if suffix[0] == "-":
+            epoch_ms = -epoch_ms
+        offset_cache[suffix] = epoch_ms
+    return epoch_ms
+
+def parse_mvalidtime(mvalidtime):
+    """Convert a Ninja mvalidtime (`2024-05-01 12:34:56.000+0000`) to epoch milliseconds.
+
+    Ninja's fixed formats are cut at fixed positions, with the date and hour
+    looked up in hour_cache, anything else goes through strptime. Numbers are
+    taken as epoch milliseconds already and returned as they are.
+    """
+    if isinstance(mvalidtime, int):
+        return mvalidtime
+    try:
+        if len(mvalidtime) == MVALIDTIME_LENGTH and mvalidtime[19] == ".":
+            millis = int(mvalidtime[20:23])
+        elif len(mvalidtime) == MVALIDTIME_LENGTH_NO_MS:
+            millis = 0
+        else:
+            return parse_mvalidtime_strptime(mvalidtime)
+        if mvalidtime[13] != ":" or mvalidtime[16] != ":":
+            return parse_mvalidtime_strptime(mvalidtime)
+        return hour_ms(mvalidtime[:13]) + int(mvalidtime[14:16]) * 60000 + int(mvalidtime[17:19]) * 1000 + millis - offset_ms(mvalidtime[-5:])
+    except ValueError:
+        return parse_mvalidtime_strptime(mvalidtime)
+
+def parse_mvalidtimes(mvalidtimes):
+    """Convert many mvalidtime strings to an int64 array of epoch milliseconds."""
+    return array('q', map(parse_mvalidtime, mvalidtimes))
@@ -0,0 +1,101 @@
+import math
+import os
+import sys
+import unittest
+from array import array
+
+# The modules live in main/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main"))
+
+import metric_engine
+from average_availability import AVAILABILITY_DATATYPE, build_metrics, compute_availability_percentage, compute_used_charging
+from query_planner import compute_metrics, compute_station_metrics, declare_metric
+from series import SeriesBatch, StationSeries
+
+NOW_MS = 1_700_000_000_000
+MINUTE_MS = 60 * 1000
+HOUR_MS = 60 * MINUTE_MS
+
+def make_batch():
+    """Stations covering the edge cases of the windows: carried in values, unknown values, nothing in the window."""
+    stations = {
+        # Every 5 minutes over two days
+        "regular": [(NOW_MS - 48 * HOUR_MS + i * 5 * MINUTE_MS, float(i % 3)) for i in range(48 * 12)],
+        # Only measured before the availability window, the carried in value holds for all of it
+        "stale": [(NOW_MS - 3 * HOUR_MS, 2.0), (NOW_MS - 90 * MINUTE_MS, 1.0)],
+        # Unknown values don't count as known time
+        "unknown": [(NOW_MS - 50 * MINUTE_MS, 1.0), (NOW_MS - 40 * MINUTE_MS, math.nan), (NOW_MS - 10 * MINUTE_MS, 0.0)],
+        # Only unknown values
+        "all-unknown": [(NOW_MS - 30 * MINUTE_MS, math.nan)],
+        # A measurement right at the start of the window and one after now
+        "edges": [(NOW_MS - HOUR_MS, 0.0), (NOW_MS - 20 * MINUTE_MS, 3.0), (NOW_MS + MINUTE_MS, 0.0)],
+        # Too old for any window
+        "gone": [(NOW_MS - 30 * HOUR_MS, 1.0)]
+    }
+    batch = SeriesBatch()
+    for name, points in stations.items():
+        batch.put(name, AVAILABILITY_DATATYPE, StationSeries(times=array('q', [t for t, v in points]), values=array('d', [v for t, v in points])))
+    # "silent" has no series at all
+    return batch, list(stations) + ["silent"]
+
+def make_metrics(names):
+    return build_metrics(names) + [
+        declare_metric("sampled-availability", compute_availability_percentage, AVAILABILITY_DATATYPE, 1, names, kernel="availability_percentage")
+    ]
+
+class MetricEngineTest(unittest.TestCase):
+    """The metric engine gives the same numbers as the metric functions run per station."""
+
+    def setUp(self):
+        self.np = metric_engine.np
+        self.batch, self.names = make_batch()
+        self.metrics = make_metrics(self.names)
+
+    def tearDown(self):
+        metric_engine.np = self.np
+
+    def expected(self, station_ids=None):
+        return {name: compute_station_metrics(self.metrics, self.batch, name, NOW_MS) for name in station_ids or self.names}
+
+    def check_engine(self):
+        self.assertEqual(metric_engine.compute_batch_metrics(self.metrics, self.batch, NOW_MS), self.expected())
+        self.assertEqual(compute_metrics(self.metrics, self.batch, NOW_MS), self.expected())
+        some = ["unknown", "silent", "edges"]
+        self.assertEqual(compute_metrics(self.metrics, self.batch, NOW_MS, some), self.expected(some))
+        self.assertEqual(compute_metrics(self.metrics, self.batch.select(some), NOW_MS, some), self.expected(some))
+
+    def check_window(self, carry_in):
+        from_ms = NOW_MS - HOUR_MS
+        stations, starts, times, values = metric_engine.window_columns(self.batch, AVAILABILITY_DATATYPE, from_ms, carry_in=carry_in)
+        ends = list(starts[1:]) + [len(values)]
+        for station, start, end in zip(stations, starts, ends):
+            view = self.batch.series[(station, self.batch.datatypes.lookup(AVAILABILITY_DATATYPE))].slice(from_ms, carry_in=carry_in)
+            self.assertEqual(list(times[start:end]), list(view.times))
+            self.assertEqual([str(value) for value in values[start:end]], [str(value) for value in view.values])
+
+    def test_pure_python(self):
+        metric_engine.np = None
+        self.check_engine()
+        self.check_window(False)
+        self.check_window(True)
+
+    @unittest.skipIf(metric_engine.np is None, "NumPy is not installed")
+    def test_numpy(self):
+        self.check_engine()
+        self.check_window(False)
+        self.check_window(True)
+
+    def test_time_weighted_availability(self):
+        results = compute_metrics(self.metrics, self.batch, NOW_MS)
+        # 1.0 for 10 minutes, unknown for 30, 0.0 for the last 10
+        self.assertEqual(results["unknown"]["availability"], 50)
+        self.assertEqual(results["stale"]["availability"], 100)
+        self.assertEqual(results["all-unknown"]["availability"], 0)
+        self.assertEqual(results["silent"], {"availability": 0, "usage": 0, "sampled-availability": 0})
+
+    def test_usage_counts_samples(self):
+        results = compute_metrics(self.metrics, self.batch, NOW_MS)
+        self.assertEqual(results["edges"]["usage"], compute_used_charging(self.batch.get("edges", AVAILABILITY_DATATYPE)))
+
+if __name__ == "__main__":
+    unittest.main()